@@ -0,0 +1,97 @@
+#
+# Resilient hashing: a group gets a fixed number of routing_table buckets,
+# so the crc16 % local_length of a flow never changes. When a next hop goes
+# down, only its buckets are handed to the remaining members, and a next
+# hop coming back takes buckets from the most loaded members, so about 1/N
+# of the flows move instead of nearly all of them.
+#
+
+# Default number of routing_table buckets of a resilient group
+DEFAULT_BUCKETS = 16
+
+
+class ResilientGroup(object):
+    """
+    The buckets of a group of next hops. buckets[i] is the member of bucket
+    i. Members get buckets in proportion to their weight, 1 by default;
+    members of weight 0 start down. A group of a single member only needs
+    one bucket, whatever n_buckets.
+    """
+    def __init__(self, members, n_buckets=DEFAULT_BUCKETS, weights=None):
+        weights = weights or {}
+        self.members = list(members)
+        self.weights = dict((m, weights.get(m, 1)) for m in self.members)
+        self.live = [m for m in self.members if self.weights[m] > 0]
+        if not self.live:
+            raise ValueError("no member with a positive weight in %s" % (self.members,))
+        if len(self.members) == 1:
+            n_buckets = 1
+        if n_buckets < len(self.live):
+            raise ValueError("%i members do not fit in %i buckets" % (len(self.live), n_buckets))
+        self.counts = dict((m, 0) for m in self.members)
+        self.buckets = []
+        for _ in range(n_buckets):
+            member = self.least_loaded(self.live)
+            self.buckets.append(member)
+            self.counts[member] += 1
+
+    def load(self, member, extra=0):
+        return float(self.counts[member] + extra) / self.weights[member]
+
+    def least_loaded(self, members):
+        "The member that would be the least loaded with one more bucket"
+        return min(members, key=lambda m: (self.load(m, 1), self.members.index(m)))
+
+    def most_loaded(self, members):
+        return max(members, key=lambda m: (self.load(m), -self.members.index(m)))
+
+    def remove_member(self, member):
+        """Takes member down and gives each of its buckets to the least
+        loaded remaining member. Returns the [(bucket, new member)] changes."""
+        if member not in self.live:
+            return []
+        others = [m for m in self.live if m != member]
+        if not others:
+            raise ValueError("%s is the last live member of %s" % (member, self.members))
+        self.live = others
+        changes = []
+        for bucket, owner in enumerate(self.buckets):
+            if owner == member:
+                new_owner = self.least_loaded(others)
+                self.assign(bucket, new_owner)
+                changes.append((bucket, new_owner))
+        return changes
+
+    def add_member(self, member, weight=None):
+        """Brings member back, taking buckets from the most loaded members
+        as long as this evens out the load. Returns the [(bucket, new
+        member)] changes."""
+        if member not in self.members:
+            raise ValueError("%s is not a member of %s" % (member, self.members))
+        if weight is not None:
+            self.weights[member] = weight
+        elif self.weights[member] <= 0:
+            self.weights[member] = 1
+        if member in self.live:
+            return []
+        others = self.live
+        self.live = [m for m in self.members if m in others or m == member]
+        changes = []
+        while others:
+            donor = self.most_loaded(others)
+            if self.load(member, 1) >= self.load(donor):
+                break
+            # the last bucket of the donor moves
+            bucket = len(self.buckets) - 1 - self.buckets[::-1].index(donor)
+            self.assign(bucket, member)
+            changes.append((bucket, member))
+        return changes
+
+    def assign(self, bucket, member):
+        self.counts[self.buckets[bucket]] -= 1
+        self.counts[member] += 1
+        self.buckets[bucket] = member
+
+    def live_slots(self):
+        "The weights and bucket counts of the live members, see wcmp.oversubscription"
+        return ([self.weights[m] for m in self.live], [self.counts[m] for m in self.live])
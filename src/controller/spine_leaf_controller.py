@@ -1,10 +1,29 @@
 #!/usr/bin/env python2
 import argparse
 import grpc
+import json
+import multiprocessing
 import os
 import sys
+import time
 from time import sleep
 
+COUNTER_NAMES = ["MyIngress.ingress_port_counter",
+                 "MyIngress.routing_slot_counter",
+                 "MyEgress.egress_port_counter"]
+
+# route kind -> (table, action, match field, action param) of its entries
+ROUTE_TABLES = {
+    'sub_table_size': ("MyIngress.sub_table_size", "MyIngress.set_sub_table_size",
+                       "hdr.ipv4.dstAddr", "len"),
+    'sub_table_offset': ("MyIngress.sub_table_offset", "MyIngress.set_sub_table_offset",
+                         "hdr.ipv4.dstAddr", "offset"),
+    'routing_table': ("MyIngress.routing_table", "MyIngress.set_nhop",
+                      "metadata.final_offset", "port"),
+    'post_fix_table': ("MyIngress.post_fix_table", "MyIngress.set_nhop",
+                       "metadata.masked_dst_ip", "port"),
+}
+
 # Import P4Runtime lib from parent utils dir
 # Probably there's a better way of doing this.
 sys.path.append(
@@ -13,6 +32,11 @@ sys.path.append(
 import p4runtime_lib.bmv2
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
+from p4runtime_lib.reconcile import reconcile
+from p4runtime_lib.counter_poller import CounterPoller
+from p4runtime_lib.topology import natural_key, resolve_switch_endpoints
+from p4runtime_lib import bundle
+from p4runtime_lib.parallel import format_timings
 
 
 sys.path.append(
@@ -20,196 +44,315 @@ sys.path.append(
                  '../'))
 
 from spine_leaf_topo import *
+from wcmp import DEFAULT_GROUP_SLOTS, expand_slots, oversubscription, reduce_weights
+from resilient import ResilientGroup
 
 
 class SpineLeafRoutingTableBuilder(SpineLeafTopo):
-    def __init__(self,p4info_file_path,bmv2_file_path):
-        SpineLeafTopo.__init__(self,"","","simple_switch_grpc")
-        self.port_base = 50050
+    def __init__(self,p4info_file_path,bmv2_file_path,K=DEFAULT_K,
+                 port_weights=None,group_slots=DEFAULT_GROUP_SLOTS,resilient_buckets=0):
+        SpineLeafTopo.__init__(self,"","","simple_switch_grpc",K=K)
         self.port_dict = {}
+        self.device_id_dict = {}
         self.connection_dict = {}
+        self.pipeline_pushed = {}
+        # switch name -> [(prefix, offset, size)] of its routing_table groups
+        self.ecmp_groups = {}
+        # switch name -> {port: weight} of its next hops, 1 when missing and
+        # 0 for a port that must not be used, see load_port_weights
+        self.port_weights = port_weights or {}
+        # maximum number of routing_table slots of a weighted group
+        self.group_slots = group_slots
+        # switch name -> {group name: oversubscription error}, see wcmp.reduce_weights
+        self.group_errors = {}
+        # number of buckets of every group in resilient hashing mode, 0 otherwise
+        self.resilient_buckets = resilient_buckets
+        # switch name -> [(offset, ResilientGroup)] of its groups in that mode
+        self.resilient_groups = {}
         self.p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
-        self.bmv2_file_path = bmv2_file_path
+        self.p4info_file_path = os.path.abspath(p4info_file_path)
+        self.bmv2_file_path = os.path.abspath(bmv2_file_path)
+        self.routing_table_size = self.p4info_helper.get(
+                    'tables', name="MyIngress.routing_table").size
+        # the ids and encoders of every table are resolved once, see P4InfoHelper.prepare
+        # route kind -> builder of its table entries, see routes()
+        self.entry_builders = {}
+        for kind, (table, action, match_field, param) in ROUTE_TABLES.items():
+            self.entry_builders[kind] = self.p4info_helper.prepare(
+                    table, action, [match_field], [param])
+        self.sub_table_size_builder = self.entry_builders['sub_table_size']
+        self.sub_table_offset_builder = self.entry_builders['sub_table_offset']
+        self.routing_table_builder = self.entry_builders['routing_table']
+        self.post_fix_table_builder = self.entry_builders['post_fix_table']
 
     def run(self):
         self.build_port_dict()
-        print(self.port_dict)
-        return 
         self.setup_connections()
-        self.configure_core_switches()
-        self.configure_upper_switches()
-        self.configure_lower_switches()
+        self.configure_switches()
+        for switch in self.connection_dict.values():
+            switch.flush()
+        report = format_group_errors(self.group_errors)
+        if report:
+            print report
+
+    def switch_names(self):
+        "All the switches, in the order Mininet starts them"
+        return sorted(self.switches(), key=natural_key)
 
     def build_port_dict(self):
-        base = self.port_base
-        # core
-        tmp = base
-        for row in range(1,self.rows+1):
-            for col in range(1,self.cols+1):
-                switch_name = "core%i_%i" %(row, col)
-                offset = (row-1) * 2 + col
-                self.port_dict[switch_name] = base + offset
-                tmp = tmp + 1
-        base = tmp        
-        # lower
-        for k in range(0,self.K):
-            for switch_num in range(2):
-                switch_name = "lowr%i_%i" %(k, switch_num)
-                offset = 2*k + switch_num+1
-                self.port_dict[switch_name] = base + offset
-                tmp = tmp + 1
-        base = tmp
-        # upper
-        for k in range(0,self.K):
-            for switch_num in range(2,4):
-                switch_name = "uppr%i_%i" %(k, switch_num)
-                offset = 2*k + switch_num-1
-                self.port_dict[switch_num] = base + offset
-                tmp = tmp + 1
-        base = tmp        
+        # gRPC ports and device ids are assigned in start order, see
+        # p4runtime_lib.topology.resolve_switch_endpoints
+        endpoints = resolve_switch_endpoints(dict((name, {}) for name in self.switch_names()))
+        for switch_name, (grpc_port, device_id) in endpoints.items():
+            self.port_dict[switch_name] = grpc_port
+            self.device_id_dict[switch_name] = device_id
 
     def setup_connections(self):
-        all_switches = self.core_switches.keys() + self.aggre_upper_switches.keys() + self.aggre_lower_switches.keys()
-        for swtich in all_switches:
+        for swtich in self.switch_names():
             self.connection_dict[swtich] = p4runtime_lib.bmv2.Bmv2SwitchConnection(
                 name=swtich,
                 address='127.0.0.1:%i' %(self.port_dict[swtich]),
-                device_id=0,
+                device_id=self.device_id_dict[swtich],
                 proto_dump_file='../logs/%s-p4runtime-requests.txt' %(swtich))
             self.connection_dict[swtich].MasterArbitrationUpdate()
-            self.connection_dict[swtich].SetForwardingPipelineConfig(p4info=self.p4info_helper.p4info,
+            self.pipeline_pushed[swtich] = self.connection_dict[swtich].SetForwardingPipelineConfig(
+                                       p4info=self.p4info_helper.p4info,
                                        bmv2_json_file_path=self.bmv2_file_path)
 
-    def configure_core_switches(self):
-         for row in range(1,self.rows+1):
-            for col in range(1,self.cols+1):
-                global_offset = 0
-                switch_name = "core%i_%i" %(row, col)
-                switch = self.connection_dict[switch_name]
-                for k in range(0,4):
-                    local_offset = 0
-                    dst_ip = "10.%i.0.0" %(k)
-                    mask_length = 16
-                    table_size = 1
-                    table_size_entry = self.sub_table_size_entry(dst_ip, mask_length, table_size)
-                    table_offset_entry = self.sub_table_offset_entry(dst_ip, mask_length, global_offset)
-                    routing_table_entry = self.global_routing_table_entry(global_offset+local_offset, k)
-                    switch.WriteTableEntry(table_size_entry)
-                    switch.WriteTableEntry(table_offset_entry)
-                    switch.WriteTableEntry(routing_table_entry)
-                    global_offset = global_offset + table_size
-    
-    def configure_upper_switches(self):
+    def configure_switches(self):
+        for switch_name in self.switch_names():
+            self.write_entries(switch_name, self.entries(switch_name))
+
+    def core_routes(self, row, col):
+        # every pod is behind one port
         for k in range(0,self.K):
-            for switch_num in range(2,4):
-                switch_name = "uppr%i_%i" %(k, switch_num)
-                switch = self.connection_dict[switch_name]
-                global_offset = 0
-                # inner pod forward to lower switches
-                table_size = 2
-                local_offset = 0
-                dst_ip = "10.%i.%i.0" %(k, switch_num)
-                mask_length = 24
-                inner_pod_table_size_entry = self.sub_table_size_entry(dst_ip, mask_length, table_size)
-                inner_pod_table_offset_entry = self.sub_table_offset_entry(dst_ip, mask_length, global_offset)
-                switch.WriteTableEntry(inner_pod_table_offset_entry)
-                switch.WriteTableEntry(inner_pod_table_size_entry)
-                for port in range(0,2):
-                    inner_pod_routing_table_entry = self.global_routing_table_entry(global_offset+local_offset, port)
-                    switch.WriteTableEntry(inner_pod_routing_table_entry)                    
-                    local_offset = local_offset + 1
+            yield "10.%i.0.0" %(k), 16, [k]
+
+    def upper_routes(self, k, switch_num):
+        # inner pod forward to the lower switch of the subnet
+        for lower in range(0,self.half):
+            yield "10.%i.%i.0" %(k, lower), 24, [lower]
+
+    def upper_post_fix_routes(self, k, switch_num):
+        # intra pod forward to core switches, spread by host number
+        for target in range(2,self.half+2):
+            port = (target-2+switch_num)%self.half + self.half
+            yield "0.0.0.%i" %(target), port
+
+    def lower_routes(self, k, switch_num):
+        # direct forward
+        for port in range(0,self.half):
+            yield "10.%i.%i.%i" %(k, switch_num, port+2), 32, [port]
+        # inner pod forward to upper switch
+        for target in range(0,self.K):
+            yield "10.%i.0.0" %(target), 16, range(self.half,self.K)
+
+    def switch_routes(self, switch_name):
+        """Returns the ECMP groups of a switch as (dst_ip, mask_length, ports)
+        and its post_fix_table entries as (ip, port), both lazily"""
+        kind, k, num = switch_name[:4], switch_name[4:].split('_')[0], switch_name.split('_')[1]
+        k, num = int(k), int(num)
+        if kind == 'core':
+            return self.core_routes(k, num), ()
+        elif kind == 'uppr':
+            return self.upper_routes(k, num), self.upper_post_fix_routes(k, num)
+        elif kind == 'lowr':
+            return self.lower_routes(k, num), ()
+        raise ValueError("unknown switch %s" % switch_name)
+
+    def next_hop_slots(self, switch_name, ports):
+        """Returns the routing_table slots of a group of next-hop ports, each
+        port repeated in proportion to its weight, the oversubscription error
+        of the split and, in resilient hashing mode, the ResilientGroup
+        owning the slots"""
+        weights = self.port_weights.get(switch_name, {})
+        if self.resilient_buckets:
+            group = ResilientGroup(ports, self.resilient_buckets, weights)
+            return list(group.buckets), oversubscription(*group.live_slots()), group
+        if not weights:
+            return list(ports), 0.0, None
+        slots, error = reduce_weights([weights.get(port, 1) for port in ports],
+                                      self.group_slots)
+        return expand_slots(ports, slots), error, None
+
+    def routes(self, switch_name):
+        """Lazily yields the entries of a switch as (kind, match, param)
+        tuples, kind being the table, and records its ECMP groups. Each
+        prefix gets a sub_table_size and a sub_table_offset entry. Each
+        distinct list of next-hop slots (of next-hop ports for resilient
+        groups) gets its routing_table slots written once and shared by all
+        the prefixes using it, so the table fills up with the number of
+        groups rather than of prefixes."""
+        groups, post_fix = self.switch_routes(switch_name)
+        self.ecmp_groups[switch_name] = []
+        self.group_errors[switch_name] = {}
+        self.resilient_groups[switch_name] = []
+        # next-hop slots -> offset of their slots
+        group_offsets = {}
+        global_offset = 0
+        for dst_ip, mask_length, ports in groups:
+            try:
+                slots, error, resilient_group = self.next_hop_slots(switch_name, ports)
+            except ValueError as e:
+                raise Exception("%s %s/%i: %s" %(switch_name, dst_ip, mask_length, e))
+            table_size = len(slots)
+            group_key = tuple(ports) if resilient_group else tuple(slots)
+            offset = group_offsets.get(group_key)
+            if offset is None:
+                if global_offset + table_size > self.routing_table_size:
+                    raise Exception("%s needs more than the %i slots of routing_table"
+                                    %(switch_name, self.routing_table_size))
+                offset = group_offsets[group_key] = global_offset
+                if resilient_group:
+                    self.resilient_groups[switch_name].append((offset, resilient_group))
+                for local_offset, port in enumerate(slots):
+                    yield 'routing_table', offset+local_offset, port
+                # a shared group is named after its first prefix
+                self.add_group(switch_name, dst_ip, mask_length, offset, table_size)
+                self.group_errors[switch_name]["%s/%i" %(dst_ip, mask_length)] = error
                 global_offset = global_offset + table_size
+            yield 'sub_table_size', (dst_ip, mask_length), table_size
+            yield 'sub_table_offset', (dst_ip, mask_length), offset
+        for ip, port in post_fix:
+            yield 'post_fix_table', ip, port
 
-                #intra pod forward to core switches
-                mask_length = 32
-                for target in range(2,4):
-                    port = (target-2+switch_num)%2 + 2
-                    ip = "0.0.0.%i" %(target)
-                    post_fix_entry = self.post_fix_table_entry(ip, port)
-                    switch.WriteTableEntry(post_fix_entry)
+    def entries(self, switch_name):
+        "Lazily yields the table entries of a switch"
+        for kind, match, param in self.routes(switch_name):
+            yield self.entry_builders[kind].build([match], [param])
 
-    def configure_lower_switches(self):
-        for k in range(0,self.K):
-            for switch_num in range(2):
-                switch_name = "lowr%i_%i" %(k, switch_num)
-                switch = self.connection_dict[switch_name]
-                global_offset = 0
-                
-                # direct forward
-                mask_length = 32
-                for port in range(0,2):
-                    table_size = 1
-                    dst_ip = "10.%i.%i.%i" %(k, switch_num, port+2)
-                    direct_table_size_entry = self.sub_table_size_entry(dst_ip,mask_length,table_size)
-                    direct_table_offset_entry = self.sub_table_offset_entry(dst_ip,mask_length,global_offset)
-                    direct_routing_table_entry = self.global_routing_table_entry(global_offset,port)
-                    switch.WriteTableEntry(direct_table_size_entry)                    
-                    switch.WriteTableEntry(direct_table_offset_entry)                    
-                    switch.WriteTableEntry(direct_routing_table_entry)                    
-                    global_offset = global_offset + table_size
-                
-                # inner pod forward to upper switch
-                for target in range(0,self.K):
-                    table_size = 2
-                    dst_ip = "10.%i.0.0" %(target)
-                    mask_length = 16
-                    inner_pod_table_size_entry = self.sub_table_size_entry(dst_ip, mask_length, table_size)
-                    inner_pod_table_offset_entry = self.sub_table_offset_entry(dst_ip, mask_length, global_offset)
-                    switch.WriteTableEntry(inner_pod_table_offset_entry)
-                    switch.WriteTableEntry(inner_pod_table_size_entry)
-                    local_offset = 0
-                    for port in range(2,4):
-                        inner_pod_routing_table_entry = self.global_routing_table_entry(global_offset+local_offset,port)
-                        switch.WriteTableEntry(inner_pod_routing_table_entry)
-                        local_offset = local_offset + 1                        
-                    global_offset = global_offset + table_size                    
+    def runtime_entries(self, switch_name):
+        "Lazily yields the entries of a switch in the runtime JSON format"
+        for kind, match, param in self.routes(switch_name):
+            table, action, match_field, param_name = ROUTE_TABLES[kind]
+            if isinstance(match, tuple):
+                match = list(match)
+            yield {"table": table,
+                   "match": {match_field: match},
+                   "action_name": action,
+                   "action_params": {param_name: param}}
+
+    def compile_switch(self, switch_name, output_dir, output_format='json'):
+        """Writes the entries of a switch to output_dir as runtime JSON,
+        loadable by simple_controller, or as a bundle of serialized
+        WriteRequests (see p4runtime_lib.bundle). Returns the output path
+        and the number of entries."""
+        # paths are relative to the output, like in bundle.compileRuntimeConf
+        output_base = os.path.abspath(output_dir)
+        header = {"target": "bmv2",
+                  "p4info": os.path.relpath(self.p4info_file_path, output_base),
+                  "bmv2_json": os.path.relpath(self.bmv2_file_path, output_base)}
+        if output_format == 'bundle':
+            output = os.path.join(output_dir, "%s-runtime.bundle" %(switch_name))
+            header["p4info_hash"] = bundle.p4infoHash(self.p4info_file_path)
+            with open(output, 'wb') as f:
+                return output, bundle.writeBundle(f, header, self.entries(switch_name))
+
+        output = os.path.join(output_dir, "%s-runtime.json" %(switch_name))
+        count = 0
+        with open(output, 'w') as f:
+            # written one entry per line, so the whole switch is never in memory
+            f.write(json.dumps(header, sort_keys=True)[:-1] + ',\n "table_entries": [\n')
+            for entry in self.runtime_entries(switch_name):
+                if count:
+                    f.write(',\n')
+                f.write('  ' + json.dumps(entry, sort_keys=True))
+                count += 1
+            f.write('\n]}\n')
+        return output, count
+
+    def set_port_state(self, switch_name, port, up):
+        """
+        Takes a next-hop port of a switch down, or brings it back up, in the
+        resilient groups of the switch. Only the routing_table buckets that
+        change hands are rewritten, with MODIFY updates when the switch is
+        connected. Returns the number of buckets rewritten.
+        """
+        if not self.resilient_buckets:
+            raise Exception("next-hop changes need resilient groups, see --resilient-buckets")
+        entries = []
+        for offset, group in self.resilient_groups.get(switch_name, []):
+            if port not in group.members:
+                continue
+            try:
+                changes = group.add_member(port) if up else group.remove_member(port)
+            except ValueError as e:
+                print "%s: %s, group at slot %i left unchanged" %(switch_name, e, offset)
+                continue
+            for bucket, member in changes:
+                entries.append(self.global_routing_table_entry(offset+bucket, member))
+            for prefix, group_offset, _ in self.ecmp_groups[switch_name]:
+                if group_offset == offset:
+                    self.group_errors[switch_name][prefix] = oversubscription(*group.live_slots())
+        switch = self.connection_dict.get(switch_name)
+        if switch is not None and entries:
+            switch.ModifyTableEntries(entries, pipelined=True)
+            switch.flush()
+        return len(entries)
+
+    def apply_port_events(self, lines):
+        """Applies 'down <switch> <port>' and 'up <switch> <port>' lines,
+        e.g. read from stdin, see set_port_state"""
+        for line in lines:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            if len(words) != 3 or words[0] not in ('down', 'up') or not words[2].isdigit():
+                print "expected 'down|up <switch> <port>', got '%s'" % line.strip()
+                continue
+            state, switch_name, port = words
+            if switch_name not in self.resilient_groups:
+                print "unknown switch %s" % switch_name
+                continue
+            rewritten = self.set_port_state(switch_name, int(port), state == 'up')
+            print "%s port %s %s: %i bucket(s) rewritten" %(switch_name, port, state, rewritten)
+
+    def add_group(self, switch_name, dst_ip, mask_length, offset, size):
+        prefix = "%s/%i" %(dst_ip, mask_length)
+        self.ecmp_groups.setdefault(switch_name, []).append((prefix, offset, size))
+
+    def monitor(self, interval):
+        """
+        Polls the port and routing_table slot counters of every switch and
+        prints the busiest ECMP groups, until interrupted.
+        """
+        poller = CounterPoller(self.connection_dict, self.p4info_helper, COUNTER_NAMES,
+                               interval=interval, ecmp_groups=self.ecmp_groups)
+        poller.start()
+        try:
+            while True:
+                sleep(interval)
+                for switch_name, snapshot in sorted(poller.snapshot().items()):
+                    imbalance = [(value, prefix) for prefix, value in snapshot['imbalance'].items()
+                                 if value > 0]
+                    if imbalance:
+                        value, prefix = max(imbalance)
+                        print "%s: worst ECMP imbalance %.2f (%s)" %(switch_name, value, prefix)
+        except KeyboardInterrupt:
+            poller.stop()
+
+    def write_entries(self, switch_name, entries):
+        switch = self.connection_dict[switch_name]
+        if self.pipeline_pushed[switch_name]:
+            switch.WriteTableEntries(entries, pipelined=True)
+        else:
+            # tables still hold the routes of a previous run, only write the diff
+            reconcile(switch, entries)
 
     def sub_table_size_entry(self,dst_ip, mask_length, table_size):
-        return self.p4info_helper.buildTableEntry(
-                    table_name="MyIngress.sub_table_size",
-                    match_fields={
-                        "hdr.ipv4.dstAddr": (dst_ip, mask_length)
-                    },
-                    action_name="MyIngress.set_sub_table_size",
-                    action_params={
-                        "len": table_size,
-                    })
+        return self.sub_table_size_builder.build([(dst_ip, mask_length)], [table_size])
     
     def sub_table_offset_entry(self,dst_ip, mask_length, table_offset):
-        return self.p4info_helper.buildTableEntry(
-                    table_name="MyIngress.sub_table_offset",
-                    match_fields={
-                        "hdr.ipv4.dstAddr": (dst_ip, mask_length)
-                    },
-                    action_name="MyIngress.set_sub_table_offset",
-                    action_params={
-                        "offset": table_offset,
-                    })
+        return self.sub_table_offset_builder.build([(dst_ip, mask_length)], [table_offset])
     
     def global_routing_table_entry(self,entry_index, port):
-        return self.p4info_helper.buildTableEntry(
-                    table_name="MyIngress.routing_table",
-                    match_fields={
-                        "metadata.final_offset": entry_index
-                    },
-                    action_name="MyIngress.set_nhop",
-                    action_params={
-                        "port": port
-                    })
+        return self.routing_table_builder.build([entry_index], [port])
     
     def post_fix_table_entry(self, ip, port):
-        return self.p4info_helper.buildTableEntry(
-                    table_name="MyIngress.post_fix_table",
-                    match_fields={
-                        "metadata.masked_dst_ip": ip
-                    },
-                    action_name="MyIngress.set_nhop",
-                    action_params={
-                        "port": port
-                    })
+        return self.post_fix_table_builder.build([ip], [port])
     
 
-    def readTableRules(p4info_helper, sw):
+    def readTableRules(self, p4info_helper, sw):
         """
         Reads the table entries from all tables on the switch.
 
@@ -235,13 +378,92 @@ class SpineLeafRoutingTableBuilder(SpineLeafTopo):
                     print '%r' % p.value,
                 print
 
-    def printGrpcError(e):
+    def printGrpcError(self, e):
         print "gRPC Error:", e.details(),
         status_code = e.code()
         print "(%s)" % status_code.name,
         traceback = sys.exc_info()[2]
         print "[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno)
 
+def load_port_weights(path):
+    """Reads the next-hop weights of the switches from a JSON file of the
+    form {"lowr0_0": {"2": 1, "3": 3}}: ports missing from it weigh 1, and
+    ports of weight 0 are not used"""
+    with open(path, 'r') as f:
+        weights = json.load(f)
+    return dict((str(switch_name), dict((int(port), weight) for port, weight in ports.items()))
+                for switch_name, ports in weights.items())
+
+def format_group_errors(group_errors):
+    """Returns a report of the groups whose slots do not follow the weights
+    exactly, worst first, from {switch name: {group name: error}}"""
+    inexact = [(error, switch_name, group_name)
+               for switch_name, errors in group_errors.items()
+               for group_name, error in errors.items() if error > 1e-9]
+    if not inexact:
+        return ''
+    lines = ["%i weighted group(s) oversubscribe a next hop:" % len(inexact)]
+    for error, switch_name, group_name in sorted(inexact, reverse=True):
+        lines.append("  %s %s: +%.1f%%" %(switch_name, group_name, error * 100))
+    return '\n'.join(lines)
+
+# builder of each compiler process, see compile_routes
+compiler = None
+
+def init_compiler(p4info_file_path, bmv2_file_path, K, port_weights, group_slots,
+                  resilient_buckets):
+    global compiler
+    compiler = SpineLeafRoutingTableBuilder(p4info_file_path, bmv2_file_path, K,
+                                            port_weights, group_slots, resilient_buckets)
+
+def compile_one(job):
+    switch_name, output_dir, output_format = job
+    start = time.time()
+    output, count = compiler.compile_switch(switch_name, output_dir, output_format)
+    return (switch_name, output, count, time.time() - start,
+            compiler.group_errors.get(switch_name, {}))
+
+def compile_routes(p4info_file_path, bmv2_file_path, K, output_dir,
+                   output_format='json', jobs=None, port_weights=None,
+                   group_slots=DEFAULT_GROUP_SLOTS, resilient_buckets=0):
+    """
+    Compiles the entries of every switch of the fat tree into output_dir,
+    one file per switch, on `jobs` processes (one per CPU by default). Also
+    writes a topology.json listing them. All paths are relative to
+    output_dir, so the fabric loads from any directory with
+    `simple_controller.py -t <output_dir>/topology.json --relative-paths`.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    init_args = (p4info_file_path, bmv2_file_path, K, port_weights, group_slots,
+                 resilient_buckets)
+    init_compiler(*init_args)
+    switch_names = compiler.switch_names()
+    pool = multiprocessing.Pool(jobs, init_compiler, init_args)
+    try:
+        # a timeout keeps the pool interruptible with Ctrl-C
+        results = pool.map_async(compile_one, [(switch_name, output_dir, output_format)
+                                               for switch_name in switch_names]).get(1 << 30)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    switches = {}
+    group_errors = {}
+    for switch_name, output, count, seconds, errors in results:
+        switches[switch_name] = {"runtime_json": os.path.relpath(output, output_dir)}
+        group_errors[switch_name] = errors
+    with open(os.path.join(output_dir, "topology.json"), 'w') as f:
+        json.dump({"switches": switches}, f, indent=2, sort_keys=True)
+    print format_timings([(result[0], result[3]) for result in results])
+    print "%i entries for %i switches written to %s" %(
+        sum(result[2] for result in results), len(results), output_dir)
+    print "Load them with: simple_controller.py -t %s --relative-paths" %(
+        os.path.join(output_dir, "topology.json"))
+    report = format_group_errors(group_errors)
+    if report:
+        print report
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
     parser.add_argument('--p4info', help='p4info proto in text format from p4c',
@@ -250,6 +472,26 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='../build/spine_leaf_ecmp.json')
+    parser.add_argument('-k', '--fat-tree-k', help='number of ports of each switch of the fat tree',
+                        type=int, action="store", required=False, default=DEFAULT_K)
+    parser.add_argument('--weights', help='JSON file of the next-hop weights of the switches (WCMP)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--group-slots', help='maximum number of routing_table slots of a weighted group',
+                        type=int, action="store", required=False, default=DEFAULT_GROUP_SLOTS)
+    parser.add_argument('--resilient-buckets', help='give every group this many routing_table buckets, '
+                        'so that next-hop changes only move the flows of the changed next hop',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('--port-events', help='after programming, read "down|up <switch> <port>" '
+                        'lines from stdin and rewrite the affected buckets (needs --resilient-buckets)',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--compile-dir', help='write the entries of every switch to this directory instead of programming the switches',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--format', help='format of the compiled entries',
+                        choices=['json', 'bundle'], default='json')
+    parser.add_argument('-j', '--jobs', help='number of compiler processes (default: one per CPU)',
+                        type=int, action="store", required=False, default=None)
+    parser.add_argument('--monitor-interval', help='poll counters every N seconds after programming',
+                        type=float, action="store", required=False, default=None)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -261,5 +503,18 @@ if __name__ == '__main__':
         print "\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json
         parser.exit(1)
     
-    controller = SpineLeafRoutingTableBuilder(args.p4info, args.bmv2_json)
+    port_weights = load_port_weights(args.weights) if args.weights else None
+    if args.compile_dir:
+        compile_routes(args.p4info, args.bmv2_json, args.fat_tree_k, args.compile_dir,
+                       args.format, args.jobs, port_weights, args.group_slots,
+                       args.resilient_buckets)
+        parser.exit(0)
+
+    controller = SpineLeafRoutingTableBuilder(args.p4info, args.bmv2_json, args.fat_tree_k,
+                                              port_weights, args.group_slots,
+                                              args.resilient_buckets)
     controller.run()
+    if args.port_events:
+        controller.apply_port_events(iter(sys.stdin.readline, ''))
+    if args.monitor_interval:
+        controller.monitor(args.monitor_interval)
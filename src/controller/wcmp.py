@@ -0,0 +1,86 @@
+#
+# Weighted ECMP: a group of next hops with weights is implemented by
+# replicating the routing_table slot of each member in proportion to its
+# weight. Groups only get a limited number of slots, so the weights are
+# reduced to slot counts that fit the budget while keeping the
+# oversubscription of the members as low as possible.
+#
+from fractions import gcd
+
+# Maximum number of routing_table slots of a group
+DEFAULT_GROUP_SLOTS = 64
+
+
+def oversubscription(weights, slots):
+    """Returns the worst ratio between the share of the traffic a member
+    gets with the given slot counts and its share of the weights, minus 1.
+    0 means that the slots follow the weights exactly."""
+    total_weight = float(sum(weights))
+    total_slots = float(sum(slots))
+    return max((s / total_slots) / (w / total_weight)
+               for w, s in zip(weights, slots)) - 1
+
+
+def allocate_slots(weights, n_slots):
+    """Splits n_slots between members with the largest remainder method,
+    each member getting at least one slot. Returns None if there are too
+    few slots for that."""
+    total_weight = float(sum(weights))
+    quotas = [n_slots * w / total_weight for w in weights]
+    slots = [max(1, int(q)) for q in quotas]
+    left = n_slots - sum(slots)
+    if left < 0:
+        return None
+    by_remainder = sorted(range(len(weights)), key=lambda i: slots[i] - quotas[i])
+    for i in by_remainder[:left]:
+        slots[i] += 1
+    return slots
+
+
+def reduce_weights(weights, max_slots=DEFAULT_GROUP_SLOTS):
+    """
+    Returns the slot count of each member, at most max_slots in total, and
+    the oversubscription error of the result (see oversubscription()).
+
+    Integer weights are first divided by their gcd, so groups whose weights
+    fit the budget get exact, minimal slot counts. Otherwise every size up
+    to max_slots is tried, and the one with the smallest error wins, the
+    fewest slots breaking ties. Members of weight 0 get no slot.
+    """
+    if any(w < 0 for w in weights):
+        raise ValueError("negative weight in %s" % (weights,))
+    members = [i for i, w in enumerate(weights) if w > 0]
+    if not members:
+        raise ValueError("no member with a positive weight in %s" % (weights,))
+    if len(members) > max_slots:
+        raise ValueError("%i members do not fit in %i slots" % (len(members), max_slots))
+    live_weights = [weights[i] for i in members]
+
+    max_size = max_slots
+    if all(isinstance(w, (int, long)) for w in live_weights):
+        divisor = reduce(gcd, live_weights)
+        live_weights = [w // divisor for w in live_weights]
+        # beyond the sum of the reduced weights, the slots are exact
+        max_size = min(max_slots, sum(live_weights))
+
+    best_slots, best_error = None, None
+    for n_slots in range(len(members), max_size + 1):
+        slots = allocate_slots(live_weights, n_slots)
+        if slots is None:
+            continue
+        error = oversubscription(live_weights, slots)
+        if best_error is None or error < best_error - 1e-12:
+            best_slots, best_error = slots, error
+
+    result = [0] * len(weights)
+    for i, s in zip(members, best_slots):
+        result[i] = s
+    return result, best_error
+
+
+def expand_slots(members, slots):
+    "Returns the routing_table slot contents of a group: each member repeated"
+    expanded = []
+    for member, count in zip(members, slots):
+        expanded.extend([member] * count)
+    return expanded
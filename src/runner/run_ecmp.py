@@ -41,6 +41,9 @@ sys.path.append(
 
 from spine_leaf_topo import *
 
+# Must match CPU_PORT in spine_leaf_ecmp.p4
+CPU_PORT = 255
+
 def configureP4Switch(**switch_args):
     """ Helper class that is called by mininet to initialize
         the virtual P4 switches. The purpose is to ensure each
@@ -81,6 +84,7 @@ class EcmpRunner:
             quiet    : bool     // determines if we print logger messages
             switch_json : string // json of the compiled p4 example
             bmv2_exe    : string // name or path of the p4 switch binary
+            K           : int    // number of ports of each switch of the fat tree
             topo : Topo object   // The mininet topology instance
             net : Mininet object // The mininet instance
 
@@ -98,7 +102,8 @@ class EcmpRunner:
 
 
     def __init__(self, log_dir, pcap_dir,
-                       switch_json, bmv2_exe='simple_switch', quiet=False):
+                       switch_json, bmv2_exe='simple_switch', quiet=False,
+                       K=DEFAULT_K):
         self.quiet = quiet
         # Ensure all the needed directories exist and are directories
         for dir_name in [log_dir, pcap_dir]:
@@ -110,6 +115,7 @@ class EcmpRunner:
         self.pcap_dir = pcap_dir
         self.switch_json = switch_json
         self.bmv2_exe = bmv2_exe
+        self.K = K
 
 
     def run(self):
@@ -143,13 +149,18 @@ class EcmpRunner:
         """
         self.logger("Building mininet topology.")
 
+        switch_args = {}
+        if 'grpc' in self.bmv2_exe:
+            # PacketIn/PacketOut go through the CPU port
+            switch_args['cpu_port'] = CPU_PORT
         defaultSwitchClass = configureP4Switch(
                                 sw_path=self.bmv2_exe,
                                 json_path=self.switch_json,
                                 log_console=True,
-                                pcap_dump=self.pcap_dir)
+                                pcap_dump=self.pcap_dir,
+                                **switch_args)
 
-        self.topo = SpineLeafTopo(self.log_dir, self.bmv2_exe, self.pcap_dir)
+        self.topo = SpineLeafTopo(self.log_dir, self.bmv2_exe, self.pcap_dir, K=self.K)
         
         self.net = Mininet(topo = self.topo,
                       link = TCLink,
@@ -269,6 +280,8 @@ def get_args():
     parser.add_argument('-j', '--switch_json', type=str, required=False)
     parser.add_argument('-b', '--behavioral-exe', help='Path to behavioral executable',
                                 type=str, required=False, default='simple_switch')
+    parser.add_argument('-k', '--fat-tree-k', help='Number of ports of each switch of the fat tree',
+                        type=int, required=False, default=DEFAULT_K)
     return parser.parse_args()
 
 
@@ -279,7 +292,8 @@ if __name__ == '__main__':
     args = get_args()
     print(args)
     ecmp_runner = EcmpRunner(args.log_dir, args.pcap_dir,
-                              args.switch_json, args.behavioral_exe, args.quiet)
+                              args.switch_json, args.behavioral_exe, args.quiet,
+                              args.fat_tree_k)
     # ecmp_runner = EcmpRunner(args.log_dir, args.pcap_dir,
                             #   "build/ecmp.json", "simple_switch_grpc", args.quiet)
 
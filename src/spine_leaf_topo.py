@@ -50,19 +50,30 @@ class NetworkObj:
         return ret_string
     __str__ = __repr__
 
+DEFAULT_K = 4
+
 class SpineLeafTopo(Topo):
-    """ The spine leaf topo of k=4
+    """ The spine leaf (fat-tree) topo of K-port switches, K even:
+        K pods of K/2 lower and K/2 upper switches, (K/2)^2 core switches
+        and K/2 hosts per lower switch.
+
+        Ports 0..K/2-1 of lower and upper switches face down (hosts and
+        lower switches), ports K/2..K-1 face up. Core switch port p leads to
+        pod p.
     """
-    def __init__(self, log_dir, bmv2_exe, pcap_dir, **opts):
+    def __init__(self, log_dir, bmv2_exe, pcap_dir, K=DEFAULT_K, **opts):
         Topo.__init__(self, **opts)
+        if K < 2 or K % 2:
+            raise ValueError("K must be an even number >= 2, not %r" % K)
         self.log_dir = log_dir
         self.bmv2_exe = bmv2_exe
         self.pcap_dir = pcap_dir
         self.switch_class = None
 
-        self.K = 4
-        self.rows = 2
-        self.cols = 2
+        self.K = K
+        self.half = K / 2
+        self.rows = self.half
+        self.cols = self.half
 
         self.core_switches = self.create_core_switches()
         self.aggre_upper_switches = self.create_upper_switches()
@@ -76,7 +87,7 @@ class SpineLeafTopo(Topo):
         for row in range(1,self.rows+1):
             for col in range(1,self.cols+1):
                 switch_name = "core%i_%i" %(row, col)
-                switch_ip = "10.4.%i.%i" %(row, col)
+                switch_ip = "10.%i.%i.%i" %(self.K, row, col)
                 self.addSwitch(switch_name, log_file="%s/%s.log" %(self.log_dir, switch_name), cls=self.switch_class)
                 # self.get(switch_name).setIP(switch_ip)
                 core_s[switch_name] = NetworkObj(switch_name, switch_ip)
@@ -85,7 +96,7 @@ class SpineLeafTopo(Topo):
     def create_upper_switches(self):
         upper_s = {}
         for k in range(0,self.K):
-            for switch_num in range(2,4):
+            for switch_num in range(self.half,self.K):
                 switch_name = "uppr%i_%i" %(k, switch_num)
                 switch_ip = "10.%i.%i.1" %(k, switch_num)
                 self.addSwitch(switch_name, ip=switch_ip, log_file="%s/%s.log" %(self.log_dir, switch_name), cls=self.switch_class)
@@ -96,7 +107,7 @@ class SpineLeafTopo(Topo):
     def create_lower_switches(self):
         lower_s = {}
         for k in range(0,self.K):
-            for switch_num in range(2):
+            for switch_num in range(self.half):
                 switch_name = "lowr%i_%i" %(k, switch_num)
                 switch_ip = "10.%i.%i.1" %(k, switch_num)
                 self.addSwitch(switch_name, ip=switch_ip, log_file="%s/%s.log" %(self.log_dir, switch_name), cls=self.switch_class)
@@ -107,11 +118,11 @@ class SpineLeafTopo(Topo):
     def create_hosts(self):
         hosts = {}
         for k in range(0,self.K):
-            for switch_num in range(2):
-                for child in range(2,4):
+            for switch_num in range(self.half):
+                for child in range(2,self.half+2):
                     host_name = "h%i_%i_%i" %(k, switch_num, child)
                     host_ip = "10.%i.%i.%i" %(k, switch_num, child)
-                    host_mac = "08:00:00:0%i:0%i:0%i" %(k, switch_num, child)
+                    host_mac = "08:00:00:%02x:%02x:%02x" %(k, switch_num, child)
                     self.addHost(host_name, ip=host_ip, mac=host_mac)
                     hosts[host_name] = NetworkObj(host_name, host_ip)
         return hosts
@@ -121,9 +132,9 @@ class SpineLeafTopo(Topo):
         bandwidth = None
         # lower switches to hosts
         for k in range(0,self.K):
-            for switch_num in range(2):
+            for switch_num in range(self.half):
                 switch_name = "lowr%i_%i" %(k, switch_num)
-                for child in range(2,self.K):
+                for child in range(2,self.half+2):
                     switch_port = child - 2
                     host_name = "h%i_%i_%i" %(k, switch_num, child)
                     self.addLink(
@@ -136,9 +147,9 @@ class SpineLeafTopo(Topo):
                     
         # lower switches to upper switches
         for k in range(0,self.K):
-            for switch_num in range(2):
+            for switch_num in range(self.half):
                 lower_switch = "lowr%i_%i" %(k, switch_num)
-                for port in range(2,self.K):
+                for port in range(self.half,self.K):
                     upper_switch = "uppr%i_%i" %(k, port)
                     self.addLink(lower_switch, upper_switch,
                         port1=port, port2=switch_num,
@@ -146,18 +157,20 @@ class SpineLeafTopo(Topo):
                     self.aggre_lower_switches[lower_switch].add_link(port, upper_switch, switch_num)
                     self.aggre_upper_switches[upper_switch].add_link(switch_num, lower_switch, port)
 
-        # core switches to upper switches
+        # core switches to upper switches: core row r reaches the upper
+        # switch K/2+r-1 of every pod, on its port K/2+col-1
         for row in range(1,self.rows+1):
             for col in range(1,self.cols+1):
                 core_switch = "core%i_%i" %(row, col)
                 for port in range(0,self.K):
-                    upper_switch = "uppr%i_%i" %(port, row+1)
+                    upper_switch = "uppr%i_%i" %(port, self.half+row-1)
+                    upper_port = self.half+col-1
                     self.addLink(
                         core_switch, upper_switch,
-                        port1=port, port2=col+1
+                        port1=port, port2=upper_port
                     )
-                    self.core_switches[core_switch].add_link(port, upper_switch, col+1)
-                    self.aggre_upper_switches[upper_switch].add_link(col+1, core_switch, port)
+                    self.core_switches[core_switch].add_link(port, upper_switch, upper_port)
+                    self.aggre_upper_switches[upper_switch].add_link(upper_port, core_switch, port)
 
     def dump_all(self):
         print("core_switches:", self.core_switches)
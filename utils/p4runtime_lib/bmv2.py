@@ -12,19 +12,83 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from switch import SwitchConnection
+import os
+import threading
+
+from file_utils import writeCacheFile
+from switch import SwitchConnection, pipelineDigest, serializePipelineConfig
 from p4.tmp import p4config_pb2
 
+# Directory, next to the BMv2 JSON file, where serialized pipeline configs
+# are kept across runs
+PIPELINE_CACHE_DIR = '.pipeline_cache'
+
+# (path, mtime, size) -> content of a BMv2 JSON file
+_device_data_cache = {}
+# content hash -> (cookie, serialized ForwardingPipelineConfig)
+_pipeline_config_cache = {}
+_cache_lock = threading.Lock()
+
+
+def readDeviceData(bmv2_json_file_path):
+    "Returns the content of a BMv2 JSON file, read from disk only once"
+    path = os.path.abspath(bmv2_json_file_path)
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    with _cache_lock:
+        device_data = _device_data_cache.get(key)
+    if device_data is None:
+        with open(path) as f:
+            device_data = f.read()
+        with _cache_lock:
+            _device_data_cache[key] = device_data
+    return device_data
+
 
 def buildDeviceConfig(bmv2_json_file_path=None):
     "Builds the device config for BMv2"
     device_config = p4config_pb2.P4DeviceConfig()
     device_config.reassign = True
-    with open(bmv2_json_file_path) as f:
-        device_config.device_data = f.read()
+    device_config.device_data = readDeviceData(bmv2_json_file_path)
     return device_config
 
 
+def buildPipelineConfig(p4info, bmv2_json_file_path=None, cache_dir=None):
+    """Returns the cookie and the serialized ForwardingPipelineConfig for BMv2.
+
+    The serialized config is built once per (p4info, BMv2 JSON) content hash
+    and shared by all the connections of the process. It is also saved in
+    cache_dir (PIPELINE_CACHE_DIR next to the JSON file by default) to be
+    reused by later runs.
+    """
+    digest = pipelineDigest(p4info.SerializeToString(),
+                            readDeviceData(bmv2_json_file_path))
+    with _cache_lock:
+        cached = _pipeline_config_cache.get(digest)
+    if cached is not None:
+        return cached
+
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(bmv2_json_file_path)), PIPELINE_CACHE_DIR)
+    cache_file = os.path.join(cache_dir, digest + '.bin')
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = (int(digest[:16], 16), f.read())
+    except IOError:
+        device_config = buildDeviceConfig(bmv2_json_file_path)
+        cached = serializePipelineConfig(
+            p4info, device_config.SerializeToString(), digest)
+        writeCacheFile(cache_file, cached[1])
+
+    with _cache_lock:
+        _pipeline_config_cache[digest] = cached
+    return cached
+
+
 class Bmv2SwitchConnection(SwitchConnection):
     def buildDeviceConfig(self, **kwargs):
         return buildDeviceConfig(**kwargs)
+
+    def buildPipelineConfig(self, p4info, **kwargs):
+        return buildPipelineConfig(p4info, **kwargs)
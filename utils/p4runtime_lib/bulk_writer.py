@@ -0,0 +1,143 @@
+#
+# Writes large numbers of updates in batches and recovers from the failure of
+# part of a batch: the per-update errors of a failed WriteRequest are parsed,
+# the updates that failed transiently are retried with backoff, and the ones
+# that failed permanently are reported, without resending the whole batch.
+#
+import time
+from collections import namedtuple
+from functools import partial
+
+from google.rpc import code_pb2
+from p4.v1 import p4runtime_pb2
+
+from error_utils import parseGrpcErrorBinaryDetails
+from switch import DEFAULT_BATCH_SIZE
+
+CONTINUE_ON_ERROR = p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR
+ROLLBACK_ON_ERROR = p4runtime_pb2.WriteRequest.ROLLBACK_ON_ERROR
+ATOMICITY_CHOICES = {'continue': CONTINUE_ON_ERROR, 'rollback': ROLLBACK_ON_ERROR}
+
+# Codes of the errors that may go away by themselves
+TRANSIENT_CODES = frozenset([code_pb2.UNAVAILABLE, code_pb2.RESOURCE_EXHAUSTED,
+                             code_pb2.DEADLINE_EXCEEDED, code_pb2.ABORTED])
+
+DEFAULT_MAX_RETRIES = 5
+# Delay before the first retry, doubled for each of the next ones
+DEFAULT_BACKOFF = 0.1
+MAX_BACKOFF = 2.0
+
+# update is the p4runtime_pb2.Update, code a google.rpc.Code
+WriteFailure = namedtuple('WriteFailure', ['update', 'code', 'message'])
+
+
+def codeName(code):
+    return code_pb2.Code.Name(code) if code in code_pb2.Code.values() else str(code)
+
+
+class BulkWriteError(Exception):
+    "Raised when some updates failed permanently, listed in failures"
+    def __init__(self, failures):
+        lines = ["%d update(s) failed:" % len(failures)]
+        for failure in failures[:10]:
+            entry = failure.update.entity.table_entry
+            lines.append("  %s table %d: %s, '%s'" % (
+                p4runtime_pb2.Update.Type.Name(failure.update.type), entry.table_id,
+                codeName(failure.code), failure.message))
+        if len(failures) > 10:
+            lines.append("  ...")
+        super(BulkWriteError, self).__init__('\n'.join(lines))
+        self.failures = failures
+
+
+def alreadyApplied(update_type, code):
+    # A retried update may have been applied by the attempt that timed out
+    return ((update_type == p4runtime_pb2.Update.INSERT and code == code_pb2.ALREADY_EXISTS) or
+            (update_type == p4runtime_pb2.Update.DELETE and code == code_pb2.NOT_FOUND))
+
+
+class BulkWriter(object):
+    """Writes (update_type, table_entry) pairs to a switch in pipelined
+    batches of batch_size updates.
+
+    With CONTINUE_ON_ERROR, only the updates that failed transiently are
+    retried. With ROLLBACK_ON_ERROR, a failed batch is rolled back by the
+    switch, so all its updates but the permanently failed ones are retried.
+    """
+    def __init__(self, sw, batch_size=DEFAULT_BATCH_SIZE, atomicity=CONTINUE_ON_ERROR,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, dry_run=False):
+        self.sw = sw
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.atomicity = atomicity
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # number of updates sent, and resent by retries
+        self.written = 0
+        self.retried = 0
+
+    def write(self, updates, raise_on_failure=True):
+        """Writes the updates, retrying the transient failures. Returns the
+        list of WriteFailures, or raises a BulkWriteError if there are some
+        and raise_on_failure is set."""
+        failures = []
+        retries = self.send(self.sw.buildWriteRequests(updates, self.batch_size, self.atomicity),
+                            0, failures)
+        attempt = 0
+        while retries and attempt < self.max_retries:
+            time.sleep(min(self.backoff * 2 ** attempt, MAX_BACKOFF))
+            attempt += 1
+            self.retried += len(retries)
+            retries = self.send(self.batches(retries), attempt, failures)
+        for update in retries:
+            failures.append(WriteFailure(update, code_pb2.UNAVAILABLE,
+                                         "still failing after %d retries" % self.max_retries))
+        if failures and raise_on_failure:
+            raise BulkWriteError(failures)
+        return failures
+
+    def batches(self, updates):
+        for i in xrange(0, len(updates), self.batch_size):
+            request = self.sw.newWriteRequest(self.atomicity)
+            request.updates.extend(updates[i:i + self.batch_size])
+            yield request
+
+    def send(self, requests, attempt, failures):
+        """Sends the requests, pipelined by the connection, and returns the
+        updates to retry"""
+        retries = []
+        for request in requests:
+            if attempt == 0:
+                self.written += len(request.updates)
+            self.sw.SubmitWrite(request, partial(self.reap, request, attempt, retries, failures),
+                                dry_run=self.dry_run)
+        self.sw.flush()
+        return retries
+
+    def reap(self, request, attempt, retries, failures, grpc_error):
+        "Sorts the updates of a completed request into retries and failures"
+        if grpc_error is None:
+            return
+        p4_errors = parseGrpcErrorBinaryDetails(grpc_error)
+        if p4_errors is None:
+            # The whole request failed, e.g. the switch was unavailable
+            code = grpc_error.code().value[0]
+            errors = dict((i, (code, grpc_error.details()))
+                          for i in xrange(len(request.updates)))
+        else:
+            errors = dict((i, (p4_error.canonical_code, p4_error.message))
+                          for i, p4_error in p4_errors)
+        rolled_back = self.atomicity == ROLLBACK_ON_ERROR
+        for i, update in enumerate(request.updates):
+            if i not in errors:
+                # applied, unless the switch rolled back the batch
+                if rolled_back:
+                    retries.append(update)
+                continue
+            code, message = errors[i]
+            if attempt and alreadyApplied(update.type, code):
+                continue
+            if code in TRANSIENT_CODES:
+                retries.append(update)
+            else:
+                failures.append(WriteFailure(update, code, message))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python2
+#
+# Bundles of precompiled WriteRequests. Compiling the table entries of a
+# runtime configuration once lets later runs replay the serialized requests
+# directly, without parsing the JSON nor building any protobuf.
+#
+# File layout:
+#   MAGIC
+#   JSON header on a single line: the runtime configuration without its
+#   table entries, plus the p4info_hash the bundle was compiled for and the
+#   number of requests and updates
+#   one record per WriteRequest: varint number of updates, varint length,
+#   WriteRequest bytes without device_id (see SwitchConnection.WriteRawRequests)
+#
+import argparse
+import hashlib
+import json
+import os
+
+from p4.v1 import p4runtime_pb2
+
+from switch import (DEFAULT_BATCH_SIZE, buildWriteRequests, decodeVarint,
+                    defaultUpdateType, encodeVarint)
+
+MAGIC = 'P4RTBUNDLE1\n'
+
+
+class BundleException(Exception):
+    pass
+
+
+def p4infoHash(p4info_fpath):
+    with open(p4info_fpath) as p4info_f:
+        return hashlib.sha256(p4info_f.read()).hexdigest()
+
+
+def isBundle(f):
+    "Checks whether the open file f is a bundle, leaving its position unchanged"
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+
+def writeBundle(f, header, table_entries, batch_size=DEFAULT_BATCH_SIZE):
+    """Writes a bundle to the open file f. header is a runtime configuration
+    dict (target, p4info, bmv2_json, ...) whose p4info path is relative to
+    the directory of the bundle. Returns the number of updates written."""
+    records = []
+    n_updates = 0
+    for request in buildWriteRequests(((defaultUpdateType(e), e) for e in table_entries),
+                                      batch_size):
+        data = request.SerializeToString()
+        records.append(encodeVarint(len(request.updates)) + encodeVarint(len(data)) + data)
+        n_updates += len(request.updates)
+    header = dict(header, requests=len(records), updates=n_updates)
+    header.pop('table_entries', None)
+    f.write(MAGIC)
+    f.write(json.dumps(header, sort_keys=True) + '\n')
+    f.write(''.join(records))
+    return n_updates
+
+
+def readBundle(f):
+    """Reads the bundle in the open file f. Returns its header and the list
+    of its (number of updates, WriteRequest bytes) records."""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise BundleException("not a bundle")
+    header = json.loads(f.readline())
+    data = f.read()
+    records = []
+    pos = 0
+    while pos < len(data):
+        n_updates, pos = decodeVarint(data, pos)
+        length, pos = decodeVarint(data, pos)
+        records.append((n_updates, data[pos:pos + length]))
+        pos += length
+    if len(records) != header['requests']:
+        raise BundleException("truncated bundle: %d of %d requests"
+                              % (len(records), header['requests']))
+    return header, records
+
+
+def checkP4Info(header, workdir):
+    "Raises a BundleException if the p4info changed since the bundle was compiled"
+    if p4infoHash(os.path.join(workdir, header['p4info'])) != header['p4info_hash']:
+        raise BundleException("%s changed since the bundle was compiled, recompile it"
+                              % header['p4info'])
+
+
+def bundleTableEntries(records):
+    "Yields the table entries of the records of a bundle"
+    for _, data in records:
+        for update in p4runtime_pb2.WriteRequest.FromString(data).updates:
+            yield update.entity.table_entry
+
+
+def compileRuntimeConf(sw_conf_file, workdir, output, batch_size=DEFAULT_BATCH_SIZE):
+    """Compiles the table entries of a runtime configuration file into the
+    bundle output. Returns the number of updates written."""
+    import helper
+    import simple_controller
+
+    sw_conf = simple_controller.json_load_byteified(sw_conf_file)
+    simple_controller.check_switch_conf(sw_conf=sw_conf, workdir=workdir)
+    p4info_fpath = os.path.join(workdir, sw_conf['p4info'])
+    p4info_helper = helper.P4InfoHelper(p4info_fpath)
+
+    # Paths are made relative to the bundle so it can be replayed from anywhere
+    bundle_dir = os.path.dirname(os.path.abspath(output))
+    header = dict(sw_conf, p4info_hash=p4infoHash(p4info_fpath))
+    for conf_key in ('p4info', 'bmv2_json'):
+        if conf_key in sw_conf:
+            header[conf_key] = os.path.relpath(os.path.join(workdir, sw_conf[conf_key]),
+                                               bundle_dir)
+
+    table_entries = (simple_controller.buildTableEntry(flow, p4info_helper)
+                     for flow in sw_conf.get('table_entries', []))
+    with open(output, 'wb') as f:
+        return writeBundle(f, header, table_entries, batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compiles runtime configurations into bundles')
+    parser.add_argument('runtime_conf_files', nargs='+',
+                        help='runtime configuration files (JSON)')
+    parser.add_argument('-o', '--output-dir',
+                        help='directory of the bundles (default: next to each file)',
+                        type=str, action="store", required=False)
+    parser.add_argument('-b', '--batch-size',
+                        help='maximum number of updates per WriteRequest',
+                        type=int, action="store", default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    for runtime_conf_file in args.runtime_conf_files:
+        workdir = os.path.dirname(os.path.abspath(runtime_conf_file))
+        output = os.path.splitext(runtime_conf_file)[0] + '.bundle'
+        if args.output_dir:
+            output = os.path.join(args.output_dir, os.path.basename(output))
+        with open(runtime_conf_file, 'r') as sw_conf_file:
+            n_updates = compileRuntimeConf(sw_conf_file, workdir, output, args.batch_size)
+        print "%s: %d updates -> %s" % (runtime_conf_file, n_updates, output)
+
+
+if __name__ == '__main__':
+    main()
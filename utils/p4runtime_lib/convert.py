@@ -14,8 +14,13 @@
 #
 import re
 import socket
+import struct
 
-import math
+try:
+    import numpy as np
+except ImportError:
+    # encode_many/decode_many fall back to per-value conversion
+    np = None
 
 '''
 This package contains several helper functions for encoding to and decoding from byte strings:
@@ -45,38 +50,161 @@ def decodeIPv4(encoded_ip_addr):
     return socket.inet_ntoa(encoded_ip_addr)
 
 def bitwidthToBytes(bitwidth):
-    return int(math.ceil(bitwidth / 8.0))
+    return (bitwidth + 7) // 8
+
+uint64 = struct.Struct('>Q')
+# Byte lengths with a native struct format, others are sliced from uint64
+num_structs = {1: struct.Struct('>B'), 2: struct.Struct('>H'),
+               4: struct.Struct('>I'), 8: uint64}
 
 def encodeNum(number, bitwidth):
+    if number < 0 or number >> bitwidth:
+        raise Exception("Number, %d, does not fit in %d bits" % (number, bitwidth))
     byte_len = bitwidthToBytes(bitwidth)
+    num_struct = num_structs.get(byte_len)
+    if num_struct is not None:
+        return num_struct.pack(number)
+    if byte_len < 8:
+        return uint64.pack(number)[8 - byte_len:]
     num_str = '%x' % number
-    if number >= 2 ** bitwidth:
-        raise Exception("Number, %d, does not fit in %d bits" % (number, bitwidth))
     return ('0' * (byte_len * 2 - len(num_str)) + num_str).decode('hex')
 
 def decodeNum(encoded_number):
+    if len(encoded_number) <= 8:
+        return uint64.unpack(encoded_number.rjust(8, '\x00'))[0]
     return int(encoded_number.encode('hex'), 16)
 
+def encodeStr(x, bitwidth):
+    # Cheap checks first: the regexes only run on plausible candidates
+    if len(x) == 17 and x[2] == ':' and matchesMac(x):
+        return encodeMac(x)
+    elif x.count('.') == 3 and matchesIPv4(x):
+        return encodeIPv4(x)
+    # Assume that the string is already encoded
+    return x
+
+def encodeNumpyNum(x, bitwidth):
+    # NumPy integers do not shift like Python ones, e.g. uint64 >> int fails
+    return encodeNum(long(x), bitwidth)
+
+encoders = {str: encodeStr, int: encodeNum, long: encodeNum}
+if np is not None:
+    for t in np.sctypes['int'] + np.sctypes['uint']:
+        encoders[t] = encodeNumpyNum
+
 def encode(x, bitwidth):
     'Tries to infer the type of `x` and encode it'
-    byte_len = bitwidthToBytes(bitwidth)
     if (type(x) == list or type(x) == tuple) and len(x) == 1:
         x = x[0]
-    encoded_bytes = None
+    encoder = encoders.get(type(x))
+    if encoder is None:
+        raise Exception("Encoding objects of %r is not supported" % type(x))
+    encoded_bytes = encoder(x, bitwidth)
+    assert(len(encoded_bytes) == bitwidthToBytes(bitwidth))
+    return encoded_bytes
+
+def inferKind(x):
+    "Returns the kind of value used by encode_many: 'mac', 'ipv4', 'raw' or 'num'"
     if type(x) == str:
-        if matchesMac(x):
-            encoded_bytes = encodeMac(x)
+        if len(x) == 17 and matchesMac(x):
+            return 'mac'
         elif matchesIPv4(x):
-            encoded_bytes = encodeIPv4(x)
+            return 'ipv4'
+        return 'raw'
+    elif type(x) in encoders:
+        return 'num'
+    return None
+
+def encode_many(values, bitwidth, kind=None):
+    """Encodes a sequence of values of the same kind ('mac', 'ipv4', 'raw'
+    or 'num', inferred from the first value if None) with NumPy. Returns the
+    list of encoded byte strings, as encode() would for each value."""
+    values = list(values)
+    if not values:
+        return []
+    if kind is None:
+        kind = inferKind(values[0])
+    byte_len = bitwidthToBytes(bitwidth)
+    if np is None or kind is None:
+        return [encode(x, bitwidth) for x in values]
+
+    if kind == 'raw':
+        data = ''.join(values)
+    elif kind == 'mac':
+        data = ''.join(values).replace(':', '').decode('hex')
+        kind_len = 6
+    elif kind == 'ipv4':
+        octets = np.array(' '.join(values).replace('.', ' ').split(), dtype=np.int64)
+        if len(octets) != 4 * len(values) or (octets > 255).any():
+            raise Exception("Invalid IPv4 address in %r" % values)
+        data = octets.astype(np.uint8).tobytes()
+        kind_len = 4
+    elif kind == 'num':
+        nums = np.asarray(values)
+        if bitwidth > 64 or nums.dtype.kind not in 'iu':
+            # values of 64 bits or more end up in object (or float) arrays
+            return [encode(x, bitwidth) for x in values]
+        if (nums < 0).any() or (bitwidth < 64 and (nums.astype(np.uint64) >> np.uint64(bitwidth)).any()):
+            raise Exception("Numbers do not fit in %d bits" % bitwidth)
+        be_bytes = nums.astype('>u8').view(np.uint8).reshape(-1, 8)
+        if byte_len <= 8:
+            data = be_bytes[:, 8 - byte_len:].tobytes()
         else:
-            # Assume that the string is already encoded
-            encoded_bytes = x
-    elif type(x) == int:
-        encoded_bytes = encodeNum(x, bitwidth)
+            padding = np.zeros((len(values), byte_len - 8), dtype=np.uint8)
+            data = np.hstack([padding, be_bytes]).tobytes()
+        kind_len = byte_len
     else:
-        raise Exception("Encoding objects of %r is not supported" % type(x))
-    assert(len(encoded_bytes) == byte_len)
-    return encoded_bytes
+        raise Exception("Unknown kind of value %r" % kind)
+
+    if kind == 'raw':
+        encoded = values
+    else:
+        encoded = [data[i:i + kind_len] for i in xrange(0, len(data), kind_len)]
+    for encoded_bytes in encoded:
+        assert(len(encoded_bytes) == byte_len)
+    return encoded
+
+def joinColumns(columns, sep):
+    joined = columns[0]
+    for column in columns[1:]:
+        joined = np.char.add(np.char.add(joined, sep), column)
+    return joined
+
+hex_bytes = None
+
+def decode_many(encoded_values, kind='num'):
+    """Decodes a sequence of byte strings of the same kind with NumPy.
+
+    'num' returns an array of integers (uint64, or Python integers for values
+    wider than 64 bits), 'ipv4' and 'mac' a list of address strings. Values
+    may have had their leading zero bytes stripped.
+    """
+    global hex_bytes
+    encoded_values = list(encoded_values)
+    if np is None:
+        decoder = {'num': decodeNum, 'ipv4': decodeIPv4, 'mac': decodeMac}[kind]
+        return [decoder(x) for x in encoded_values]
+    if not encoded_values:
+        return np.zeros(0, dtype=np.uint64) if kind == 'num' else []
+    width = {'ipv4': 4, 'mac': 6}.get(kind)
+    if width is None:
+        width = max([len(x) for x in encoded_values] + [1])
+    data = ''.join(x.rjust(width, '\x00') for x in encoded_values)
+    octets = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+
+    if kind == 'num':
+        if width > 8:
+            return np.array([decodeNum(x) for x in encoded_values], dtype=object)
+        padded = np.zeros((len(octets), 8), dtype=np.uint8)
+        padded[:, 8 - width:] = octets
+        return padded.view('>u8').reshape(-1).astype(np.uint64)
+    elif kind == 'ipv4':
+        return list(joinColumns(octets.astype(str).T, '.'))
+    elif kind == 'mac':
+        if hex_bytes is None:
+            hex_bytes = np.array(['%02x' % i for i in range(256)])
+        return list(joinColumns(hex_bytes[octets].T, ':'))
+    raise Exception("Unknown kind of value %r" % kind)
 
 if __name__ == '__main__':
     # TODO These tests should be moved out of main eventually
@@ -110,6 +238,25 @@ if __name__ == '__main__':
     assert(encode((num,), 5 * 8) == enc_num)
     assert(encode([num], 5 * 8) == enc_num)
 
+    nums = [0, 1, 1337, 2 ** 40 - 1]
+    enc_nums = encode_many(nums, 5 * 8)
+    assert(enc_nums == [encodeNum(x, 5 * 8) for x in nums])
+    assert(list(decode_many(enc_nums)) == nums)
+    wide_nums = [1, 2 ** 64, 2 ** 100 + 7]
+    enc_wide = encode_many(wide_nums, 128)
+    assert(enc_wide == [encodeNum(x, 128) for x in wide_nums])
+    assert(list(decode_many(enc_wide)) == wide_nums)
+    if np is not None:
+        assert(encode(np.uint64(num), 5 * 8) == encodeNum(num, 5 * 8))
+        assert(encode(np.int32(num), 5 * 8) == encodeNum(num, 5 * 8))
+        # decoded columns are uint64 arrays, which must encode back
+        assert(encode(decode_many(enc_nums)[2], 5 * 8) == enc_nums[2])
+        assert(encode_many(decode_many(enc_nums), 128) == [encodeNum(x, 128) for x in nums])
+    assert(encode_many([mac, mac], 6 * 8) == [enc_mac, enc_mac])
+    assert(decode_many([enc_mac], 'mac') == [mac])
+    assert(encode_many([ip], 4 * 8) == [enc_ip])
+    assert(decode_many([enc_ip], 'ipv4') == [ip])
+
     num = 256
     byte_len = 2
     try:
@@ -0,0 +1,143 @@
+#
+# Periodically reads indirect counters from a set of switches over their
+# P4Runtime connections and keeps the recent samples in preallocated NumPy
+# ring buffers, from which packet/byte rates and the load imbalance of ECMP
+# groups are computed.
+#
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_POLL_INTERVAL = 1.0
+# Samples kept per counter: the two needed for rates. Each sample holds two
+# int64 arrays of the counter size, so a longer history is opt-in.
+DEFAULT_HISTORY = 2
+
+
+class CounterRing(object):
+    """The last `history` samples of a counter array.
+
+    packets and bytes are (history, size) arrays; the sample i is stored in
+    row i % history, with its timestamp in times.
+    """
+    def __init__(self, size, history=DEFAULT_HISTORY):
+        if history < 2:
+            raise ValueError("rates need a history of at least 2 samples, got %d" % history)
+        self.size = size
+        self.history = history
+        self.times = np.zeros(history)
+        self.packets = np.zeros((history, size), dtype=np.int64)
+        self.bytes = np.zeros((history, size), dtype=np.int64)
+        self.count = 0
+
+    def append(self, timestamp, indexes, packets, bytes):
+        row = self.count % self.history
+        if self.count and len(indexes) < self.size:
+            # indexes missing from the read keep their previous value
+            prev = (self.count - 1) % self.history
+            self.packets[row] = self.packets[prev]
+            self.bytes[row] = self.bytes[prev]
+        self.times[row] = timestamp
+        self.packets[row, indexes] = packets
+        self.bytes[row, indexes] = bytes
+        self.count += 1
+
+    def rates(self):
+        """Returns the packet and byte rates per index between the last two
+        samples, or None before the second sample"""
+        if self.count < 2:
+            return None
+        last = (self.count - 1) % self.history
+        prev = (self.count - 2) % self.history
+        elapsed = self.times[last] - self.times[prev]
+        # counters are reset when a pipeline is pushed
+        packet_rates = np.maximum(self.packets[last] - self.packets[prev], 0) / elapsed
+        byte_rates = np.maximum(self.bytes[last] - self.bytes[prev], 0) / elapsed
+        return packet_rates, byte_rates
+
+
+def groupImbalance(byte_rates, offset, size):
+    """Ratio between the busiest member of an ECMP group and the mean of its
+    members: 1.0 is a perfect split, `size` means all traffic on one member.
+    Returns 0.0 for a group without traffic."""
+    rates = byte_rates[offset:offset + size]
+    mean = rates.mean()
+    if mean == 0:
+        return 0.0
+    return float(rates.max() / mean)
+
+
+class CounterPoller(threading.Thread):
+    """Reads counter_names from every connection each interval seconds.
+
+    connections maps switch names to SwitchConnections, which are reused
+    for every poll. ecmp_groups optionally maps switch names to a list of
+    (group name, offset, size) slot ranges of the group_counter, whose
+    imbalance is reported by snapshot().
+    """
+    def __init__(self, connections, p4info_helper, counter_names,
+                 interval=DEFAULT_POLL_INTERVAL, history=DEFAULT_HISTORY,
+                 ecmp_groups=None, group_counter='MyIngress.routing_slot_counter'):
+        super(CounterPoller, self).__init__(name='CounterPoller')
+        self.daemon = True
+        self.connections = connections
+        self.interval = interval
+        self.ecmp_groups = ecmp_groups or {}
+        self.group_counter = group_counter
+        self.counter_ids = {}
+        self.rings = {}
+        for counter_name in counter_names:
+            counter = p4info_helper.get('counters', name=counter_name)
+            self.counter_ids[counter_name] = counter.preamble.id
+            for sw_name in connections:
+                self.rings[(sw_name, counter_name)] = CounterRing(counter.size, history)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def pollOnce(self):
+        for sw_name, sw in self.connections.iteritems():
+            for counter_name, counter_id in self.counter_ids.iteritems():
+                timestamp = time.time()
+                indexes = []
+                packets = []
+                bytes = []
+                for response in sw.ReadCounters(counter_id=counter_id):
+                    for entity in response.entities:
+                        entry = entity.counter_entry
+                        indexes.append(entry.index.index)
+                        packets.append(entry.data.packet_count)
+                        bytes.append(entry.data.byte_count)
+                with self.lock:
+                    self.rings[(sw_name, counter_name)].append(
+                        timestamp, np.array(indexes, dtype=np.int64),
+                        np.array(packets, dtype=np.int64), np.array(bytes, dtype=np.int64))
+
+    def run(self):
+        deadline = time.time()
+        while not self.stopped.is_set():
+            self.pollOnce()
+            deadline += self.interval
+            self.stopped.wait(max(0, deadline - time.time()))
+
+    def stop(self):
+        self.stopped.set()
+
+    def snapshot(self):
+        """Returns the latest rates as
+        {switch: {'rates': {counter: (packet_rates, byte_rates)},
+                  'imbalance': {group name: imbalance}}}
+        Counters with less than two samples are left out."""
+        result = {}
+        with self.lock:
+            for (sw_name, counter_name), ring in self.rings.iteritems():
+                rates = ring.rates()
+                if rates is None:
+                    continue
+                sw_snapshot = result.setdefault(sw_name, {'rates': {}, 'imbalance': {}})
+                sw_snapshot['rates'][counter_name] = rates
+                if counter_name == self.group_counter:
+                    for group_name, offset, size in self.ecmp_groups.get(sw_name, []):
+                        sw_snapshot['imbalance'][group_name] = groupImbalance(
+                            rates[1], offset, size)
+        return result
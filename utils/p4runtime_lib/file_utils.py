@@ -0,0 +1,22 @@
+#
+# Writes the on-disk caches of derived files (pipeline configs, binary
+# P4Info sidecars), which are only an optimization.
+#
+import os
+
+
+def writeCacheFile(path, data):
+    """Writes data to path through a temporary file renamed over it, so
+    concurrent readers never see a partial file. Failing to write a cache is
+    harmless: returns False instead of raising."""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        return False
+    return True
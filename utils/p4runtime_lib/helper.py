@@ -12,34 +12,131 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
+import os
 import re
+import threading
 
 import google.protobuf.text_format
 from p4.v1 import p4runtime_pb2
 from p4.config.v1 import p4info_pb2
 
-from convert import encode
+from convert import encode, encode_many, decodeNum
+from file_utils import writeCacheFile
+
+# Default digest configuration: the switch sends a DigestList after 1ms or
+# when it holds 128 digests, and resends unacknowledged lists after 1s
+DEFAULT_DIGEST_MAX_TIMEOUT_NS = 1000000
+DEFAULT_DIGEST_MAX_LIST_SIZE = 128
+DEFAULT_DIGEST_ACK_TIMEOUT_NS = 1000000000
+
+# Patterns of the convenience lookups synthesized by P4InfoHelper.__getattr__
+ID_LOOKUP_PATTERN = re.compile(r"^get_(\w+)_id$")
+NAME_LOOKUP_PATTERN = re.compile(r"^get_(\w+)_name$")
+
+# (path, content hash) -> P4Info parsed from that text p4info file
+_p4info_cache = {}
+_p4info_cache_lock = threading.Lock()
+
+def loadP4Info(p4_info_filepath):
+    """Returns the P4Info of a text-format p4info file.
+
+    Text parsing is slow, so the result is cached for the whole process by
+    path and content hash, and also saved next to the file in binary form
+    (see binaryP4InfoPath) to be read directly by later runs. The returned
+    P4Info is shared and must not be modified.
+    """
+    path = os.path.abspath(p4_info_filepath)
+    with open(path) as p4info_f:
+        text = p4info_f.read()
+    digest = hashlib.sha256(text).hexdigest()
+    with _p4info_cache_lock:
+        p4info = _p4info_cache.get((path, digest))
+    if p4info is not None:
+        return p4info
+
+    p4info = p4info_pb2.P4Info()
+    bin_path = binaryP4InfoPath(path)
+    if not readBinaryP4Info(bin_path, digest, p4info):
+        # Load the p4info file into a skeleton P4Info object
+        google.protobuf.text_format.Merge(text, p4info)
+        writeBinaryP4Info(bin_path, digest, p4info)
+    with _p4info_cache_lock:
+        _p4info_cache[(path, digest)] = p4info
+    return p4info
+
+def binaryP4InfoPath(p4_info_filepath):
+    "foo.p4.p4info.txt -> foo.p4.p4info.bin"
+    return os.path.splitext(p4_info_filepath)[0] + '.bin'
+
+def readBinaryP4Info(bin_path, digest, p4info):
+    """Parses the binary sidecar into p4info if it was written for the text
+    file with the given content hash, which is stored on its first line"""
+    try:
+        with open(bin_path, 'rb') as f:
+            if f.readline().rstrip('\n') != digest:
+                return False
+            p4info.ParseFromString(f.read())
+        return True
+    except IOError:
+        return False
+
+def writeBinaryP4Info(bin_path, digest, p4info):
+    writeCacheFile(bin_path, digest + '\n' + p4info.SerializeToString())
 
 class P4InfoHelper(object):
     def __init__(self, p4_info_filepath):
-        p4info = p4info_pb2.P4Info()
-        # Load the p4info file into a skeleton P4Info object
-        with open(p4_info_filepath) as p4info_f:
-            google.protobuf.text_format.Merge(p4info_f.read(), p4info)
-        self.p4info = p4info
+        self.p4info = loadP4Info(p4_info_filepath)
+        self.build_indexes()
+
+    def build_indexes(self):
+        """Indexes every entity with a preamble by name, alias and id, and the
+        match fields, action params and controller packet metadata by the
+        name of their table, action or header, so lookups are O(1)."""
+        # entity type -> {name or alias: entity} / {id: entity}
+        self.entities_by_name = {}
+        self.entities_by_id = {}
+        for field in self.p4info.DESCRIPTOR.fields:
+            if (field.label != field.LABEL_REPEATED or field.message_type is None
+                    or 'preamble' not in field.message_type.fields_by_name):
+                continue
+            by_name = self.entities_by_name[field.name] = {}
+            by_id = self.entities_by_id[field.name] = {}
+            # setdefault keeps the first match, like a scan in p4info order
+            for o in getattr(self.p4info, field.name):
+                pre = o.preamble
+                by_name.setdefault(pre.name, o)
+                by_name.setdefault(pre.alias, o)
+                by_id.setdefault(pre.id, o)
+
+        # table name -> ({match field name: field}, {match field id: field})
+        self.match_fields = self.index_members('tables', 'match_fields')
+        # action name -> ({param name: param}, {param id: param})
+        self.action_params = self.index_members('actions', 'params')
+        # 'packet_in'/'packet_out' -> ({name: metadata}, {id: metadata})
+        self.packet_metadata = self.index_members('controller_packet_metadata', 'metadata')
+
+    def index_members(self, entity_type, member_field):
+        index = {}
+        for o in getattr(self.p4info, entity_type):
+            by_name = {}
+            by_id = {}
+            for member in getattr(o, member_field):
+                by_name.setdefault(member.name, member)
+                by_id.setdefault(member.id, member)
+            index.setdefault(o.preamble.name, (by_name, by_id))
+        return index
 
     def get(self, entity_type, name=None, id=None):
         if name is not None and id is not None:
             raise AssertionError("name or id must be None")
 
-        for o in getattr(self.p4info, entity_type):
-            pre = o.preamble
-            if name:
-                if (pre.name == name or pre.alias == name):
-                    return o
-            else:
-                if pre.id == id:
-                    return o
+        if name:
+            o = self.entities_by_name.get(entity_type, {}).get(name)
+        else:
+            o = self.entities_by_id.get(entity_type, {}).get(id)
+        if o is not None:
+            return o
 
         if name:
             raise AttributeError("Could not find %r of type %s" % (name, entity_type))
@@ -58,32 +155,35 @@ class P4InfoHelper(object):
     def __getattr__(self, attr):
         # Synthesize convenience functions for name to id lookups for top-level entities
         # e.g. get_tables_id(name_string) or get_actions_id(name_string)
-        m = re.search("^get_(\w+)_id$", attr)
+        m = ID_LOOKUP_PATTERN.search(attr)
         if m:
             primitive = m.group(1)
-            return lambda name: self.get_id(primitive, name)
-
-        # Synthesize convenience functions for id to name lookups
-        # e.g. get_tables_name(id) or get_actions_name(id)
-        m = re.search("^get_(\w+)_name$", attr)
-        if m:
+            lookup = lambda name: self.get_id(primitive, name)
+        else:
+            # Synthesize convenience functions for id to name lookups
+            # e.g. get_tables_name(id) or get_actions_name(id)
+            m = NAME_LOOKUP_PATTERN.search(attr)
+            if not m:
+                raise AttributeError("%r object has no attribute %r" % (self.__class__, attr))
             primitive = m.group(1)
-            return lambda id: self.get_name(primitive, id)
+            lookup = lambda id: self.get_name(primitive, id)
+        # Cache the function so the pattern is only matched once per name
+        self.__dict__[attr] = lookup
+        return lookup
 
-        raise AttributeError("%r object has no attribute %r" % (self.__class__, attr))
+    def get_member(self, index, owner_name, name, id):
+        by_name, by_id = index.get(owner_name, ({}, {}))
+        if name is not None:
+            return by_name.get(name)
+        elif id is not None:
+            return by_id.get(id)
+        return None
 
     def get_match_field(self, table_name, name=None, id=None):
-        for t in self.p4info.tables:
-            pre = t.preamble
-            if pre.name == table_name:
-                for mf in t.match_fields:
-                    if name is not None:
-                        if mf.name == name:
-                            return mf
-                    elif id is not None:
-                        if mf.id == id:
-                            return mf
-        raise AttributeError("%r has no attribute %r" % (table_name, name if name is not None else id))
+        mf = self.get_member(self.match_fields, table_name, name, id)
+        if mf is None:
+            raise AttributeError("%r has no attribute %r" % (table_name, name if name is not None else id))
+        return mf
 
     def get_match_field_id(self, table_name, match_field_name):
         return self.get_match_field(table_name, name=match_field_name).id
@@ -132,17 +232,11 @@ class P4InfoHelper(object):
             raise Exception("Unsupported match type with type %r" % match_type)
 
     def get_action_param(self, action_name, name=None, id=None):
-        for a in self.p4info.actions:
-            pre = a.preamble
-            if pre.name == action_name:
-                for p in a.params:
-                    if name is not None:
-                        if p.name == name:
-                            return p
-                    elif id is not None:
-                        if p.id == id:
-                            return p
-        raise AttributeError("action %r has no param %r, (has: %r)" % (action_name, name if name is not None else id, a.params))
+        p = self.get_member(self.action_params, action_name, name, id)
+        if p is None:
+            params = self.action_params.get(action_name, ({}, {}))[0].keys()
+            raise AttributeError("action %r has no param %r, (has: %r)" % (action_name, name if name is not None else id, params))
+        return p
 
     def get_action_param_id(self, action_name, param_name):
         return self.get_action_param(action_name, name=param_name).id
@@ -157,6 +251,64 @@ class P4InfoHelper(object):
         p4runtime_param.value = encode(value, p4info_param.bitwidth)
         return p4runtime_param
 
+    def get_packet_metadata(self, packet_type, name=None, id=None):
+        "Returns the metadata of the 'packet_in' or 'packet_out' controller header"
+        m = self.get_member(self.packet_metadata, packet_type, name, id)
+        if m is None:
+            raise AttributeError("%r has no metadata %r" % (packet_type, name if name is not None else id))
+        return m
+
+    def buildPacketOut(self, payload, metadata=None):
+        packet_out = p4runtime_pb2.PacketOut()
+        packet_out.payload = payload
+        if metadata:
+            for name, value in metadata.iteritems():
+                p4info_meta = self.get_packet_metadata('packet_out', name=name)
+                meta = packet_out.metadata.add()
+                meta.metadata_id = p4info_meta.id
+                meta.value = encode(value, p4info_meta.bitwidth)
+        return packet_out
+
+    def decodePacketIn(self, packet_in):
+        "Returns the payload and a dict of the metadata values by name"
+        metadata = {}
+        for meta in packet_in.metadata:
+            name = self.get_packet_metadata('packet_in', id=meta.metadata_id).name
+            metadata[name] = decodeNum(meta.value)
+        return packet_in.payload, metadata
+
+    def get_digest_member_names(self, digest_name):
+        "Returns the names of the fields of the struct sent by a digest"
+        type_spec = self.get('digests', name=digest_name).type_spec
+        if type_spec.WhichOneof('type_spec') != 'struct':
+            return [digest_name]
+        struct = self.p4info.type_info.structs[type_spec.struct.name]
+        return [member.name for member in struct.members]
+
+    def buildDigestEntry(self, digest_name,
+                         max_timeout_ns=DEFAULT_DIGEST_MAX_TIMEOUT_NS,
+                         max_list_size=DEFAULT_DIGEST_MAX_LIST_SIZE,
+                         ack_timeout_ns=DEFAULT_DIGEST_ACK_TIMEOUT_NS):
+        digest_entry = p4runtime_pb2.DigestEntry()
+        digest_entry.digest_id = self.get_digests_id(digest_name)
+        digest_entry.config.max_timeout_ns = max_timeout_ns
+        digest_entry.config.max_list_size = max_list_size
+        digest_entry.config.ack_timeout_ns = ack_timeout_ns
+        return digest_entry
+
+    def decodeDigestList(self, digest_list):
+        """Returns the digest name and its data as a list of tuples of
+        integers, ordered as get_digest_member_names()"""
+        digest_name = self.get_digests_name(digest_list.digest_id)
+        decoded = []
+        for data in digest_list.data:
+            if data.WhichOneof('data') == 'struct':
+                decoded.append(tuple(decodeNum(member.bitstring)
+                                     for member in data.struct.members))
+            else:
+                decoded.append((decodeNum(data.bitstring),))
+        return digest_name, decoded
+
     def buildTableEntry(self,
                         table_name,
                         match_fields=None,
@@ -189,6 +341,12 @@ class P4InfoHelper(object):
                 ])
         return table_entry
 
+    def prepare(self, table_name, action_name, match_fields=(), params=(), priority=None):
+        """Returns a PreparedTableEntry building entries of table_name with
+        the given match field and action param names, in that order"""
+        return PreparedTableEntry(self, table_name, action_name,
+                                  match_fields, params, priority)
+
     def buildMulticastGroupEntry(self, multicast_group_id, replicas):
         mc_entry = p4runtime_pb2.PacketReplicationEngineEntry()
         mc_entry.multicast_group_entry.multicast_group_id = multicast_group_id
@@ -210,3 +368,133 @@ class P4InfoHelper(object):
             r.instance = replica['instance']
             clone_entry.clone_session_entry.replicas.extend([r])
         return clone_entry
+
+
+# Match types as (setter, encoder, column encoder): the encoders turn a match
+# value, or a column of them, into what the setter puts in a FieldMatch
+
+def setExact(field_match, encoded):
+    field_match.exact.value = encoded
+
+def setLpm(field_match, encoded):
+    field_match.lpm.value, field_match.lpm.prefix_len = encoded
+
+def setTernary(field_match, encoded):
+    field_match.ternary.value, field_match.ternary.mask = encoded
+
+def setRange(field_match, encoded):
+    field_match.range.low, field_match.range.high = encoded
+
+def encodeLpm(value, bitwidth):
+    return (encode(value[0], bitwidth), value[1])
+
+def encodePair(value, bitwidth):
+    return (encode(value[0], bitwidth), encode(value[1], bitwidth))
+
+def encodeLpmColumn(column, bitwidth):
+    if not column:
+        return []
+    values, prefix_lens = zip(*column)
+    return zip(encode_many(values, bitwidth), prefix_lens)
+
+def encodePairColumn(column, bitwidth):
+    if not column:
+        return []
+    firsts, seconds = zip(*column)
+    return zip(encode_many(firsts, bitwidth), encode_many(seconds, bitwidth))
+
+MATCH_TYPES = {
+    p4info_pb2.MatchField.EXACT: (setExact, encode, encode_many),
+    p4info_pb2.MatchField.LPM: (setLpm, encodeLpm, encodeLpmColumn),
+    p4info_pb2.MatchField.TERNARY: (setTernary, encodePair, encodePairColumn),
+    p4info_pb2.MatchField.RANGE: (setRange, encodePair, encodePairColumn),
+}
+
+
+class PreparedTableEntry(object):
+    """Builds the entries of one table and action from their match and
+    param values only.
+
+    The ids, bitwidths and encoders are resolved once by
+    P4InfoHelper.prepare(), and every entry is a copy of a template
+    TableEntry in which only the values are filled in. build_many() encodes
+    each column at once with convert.encode_many().
+    """
+    def __init__(self, p4info_helper, table_name, action_name,
+                 match_fields=(), params=(), priority=None):
+        self.table_name = table_name
+        self.action_name = action_name
+        self.match_fields = list(match_fields)
+        self.params = list(params)
+        self.template = p4runtime_pb2.TableEntry()
+        self.template.table_id = p4info_helper.get_tables_id(table_name)
+        if priority is not None:
+            self.template.priority = priority
+
+        # (setter, encoder, column encoder, bitwidth) of each match field
+        self.match_types = []
+        for match_field_name in match_fields:
+            p4info_match = p4info_helper.get_match_field(table_name, match_field_name)
+            if p4info_match.match_type not in MATCH_TYPES:
+                raise Exception("Unsupported match type with type %r" % p4info_match.match_type)
+            self.template.match.add().field_id = p4info_match.id
+            self.match_types.append(
+                MATCH_TYPES[p4info_match.match_type] + (p4info_match.bitwidth,))
+
+        action = self.template.action.action
+        action.action_id = p4info_helper.get_actions_id(action_name)
+        self.param_bitwidths = []
+        for param_name in params:
+            p4info_param = p4info_helper.get_action_param(action_name, param_name)
+            action.params.add().param_id = p4info_param.id
+            self.param_bitwidths.append(p4info_param.bitwidth)
+
+    def check_count(self, match_values, param_values):
+        if len(match_values) != len(self.match_fields):
+            raise Exception("%r expects %d match values %r, got %d" % (
+                self.table_name, len(self.match_fields), self.match_fields, len(match_values)))
+        if len(param_values) != len(self.params):
+            raise Exception("%r expects %d param values %r, got %d" % (
+                self.action_name, len(self.params), self.params, len(param_values)))
+
+    def build(self, match_values=(), param_values=()):
+        "Builds an entry from its values, ordered like the prepared names"
+        self.check_count(match_values, param_values)
+        match_values = [encoder(value, bitwidth) for (_, encoder, _, bitwidth), value
+                        in zip(self.match_types, match_values)]
+        param_values = [encode(value, bitwidth)
+                        for bitwidth, value in zip(self.param_bitwidths, param_values)]
+        return self.fill(match_values, param_values)
+
+    def fill(self, encoded_matches, encoded_params):
+        "Builds an entry from values already encoded for their field"
+        table_entry = p4runtime_pb2.TableEntry()
+        table_entry.CopyFrom(self.template)
+        for field_match, (set_value, _, _, _), encoded in zip(
+                table_entry.match, self.match_types, encoded_matches):
+            set_value(field_match, encoded)
+        for param, encoded in zip(table_entry.action.action.params, encoded_params):
+            param.value = encoded
+        return table_entry
+
+    def build_many(self, match_columns=(), param_columns=()):
+        """Yields one entry per row of the given columns: match_columns holds
+        one sequence of values per match field, param_columns one per param.
+        The values of a column must all be of the same kind, and all the
+        columns of the same length."""
+        match_columns = [list(column) for column in match_columns]
+        param_columns = [list(column) for column in param_columns]
+        self.check_count(match_columns, param_columns)
+        lengths = set(len(column) for column in match_columns + param_columns)
+        if len(lengths) > 1:
+            raise Exception("columns of different lengths %r for %r" % (
+                sorted(lengths), self.table_name))
+        if not lengths or 0 in lengths:
+            return
+        columns = [encode_column(column, bitwidth) for (_, _, encode_column, bitwidth), column
+                   in zip(self.match_types, match_columns)]
+        columns += [encode_many(column, bitwidth)
+                    for bitwidth, column in zip(self.param_bitwidths, param_columns)]
+        n_match = len(self.match_types)
+        for row in zip(*columns):
+            yield self.fill(row[:n_match], row[n_match:])
@@ -0,0 +1,90 @@
+#
+# Helpers to program several switches at the same time. Each switch is
+# programmed over its own gRPC channel, so the total bring-up time is bounded
+# by the slowest switch instead of the sum of all of them.
+#
+import threading
+import time
+from Queue import Queue, Empty
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class ParallelTaskError(Exception):
+    """Raised by run_tasks() when at least one task failed.
+
+    failures is a list of (name, exception) tuples, timings the (name, seconds)
+    tuples of the tasks that succeeded and skipped the names of the tasks that
+    were never started because of an earlier failure.
+    """
+    def __init__(self, failures, timings, skipped):
+        lines = ["%d task(s) failed:" % len(failures)]
+        for name, e in failures:
+            lines.append("  %s: %s: %s" % (name, type(e).__name__, e))
+        if skipped:
+            lines.append("  not started: %s" % ', '.join(skipped))
+        super(ParallelTaskError, self).__init__('\n'.join(lines))
+        self.failures = failures
+        self.timings = timings
+        self.skipped = skipped
+
+
+def run_tasks(tasks, max_workers=DEFAULT_MAX_WORKERS, fail_fast=True):
+    """Runs the (name, callable) tasks on at most max_workers threads.
+
+    Returns the (name, seconds) timing of every task, in completion order.
+    When fail_fast is set, no new task is started after the first failure.
+    """
+    pending = Queue()
+    for task in tasks:
+        pending.put(task)
+    timings = []
+    failures = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                name, task = pending.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                task()
+            except Exception as e:
+                with lock:
+                    failures.append((name, e))
+                if fail_fast:
+                    stop.set()
+            else:
+                with lock:
+                    timings.append((name, time.time() - start))
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(max(1, min(max_workers, len(tasks))))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        # join() with a timeout keeps the main thread responsive to Ctrl-C
+        while t.is_alive():
+            t.join(0.5)
+
+    if failures:
+        skipped = []
+        while not pending.empty():
+            skipped.append(pending.get_nowait()[0])
+        raise ParallelTaskError(failures, timings, skipped)
+    return timings
+
+
+def format_timings(timings):
+    "Returns a table with the duration of each task, slowest first"
+    if not timings:
+        return ''
+    width = max(len(name) for name, _ in timings)
+    lines = ["%-*s  %8s" % (width, 'switch', 'seconds')]
+    for name, seconds in sorted(timings, key=lambda t: -t[1]):
+        lines.append("%-*s  %8.3f" % (width, name, seconds))
+    return '\n'.join(lines)
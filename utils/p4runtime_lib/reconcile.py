@@ -0,0 +1,103 @@
+#
+# Brings the table entries of a switch to a desired state by writing only the
+# difference between the installed and the desired entries, so reprogramming a
+# running switch costs O(changes) writes instead of a full wipe and reload.
+#
+from collections import namedtuple
+
+from switch import DEFAULT_BATCH_SIZE
+
+ReconcileResult = namedtuple('ReconcileResult', ['inserted', 'modified', 'deleted'])
+
+
+def canonicalBytes(value):
+    # P4Runtime servers may strip the leading zeros of the byte strings they
+    # return, so they are ignored when comparing values
+    return value.lstrip('\x00')
+
+
+def matchKey(table_entry):
+    "Identifies a table entry by its table, match fields and priority"
+    fields = []
+    for m in sorted(table_entry.match, key=lambda m: m.field_id):
+        match_type = m.WhichOneof("field_match_type")
+        if match_type == 'exact':
+            value = (canonicalBytes(m.exact.value),)
+        elif match_type == 'lpm':
+            value = (canonicalBytes(m.lpm.value), m.lpm.prefix_len)
+        elif match_type == 'ternary':
+            value = (canonicalBytes(m.ternary.value), canonicalBytes(m.ternary.mask))
+        elif match_type == 'range':
+            value = (canonicalBytes(m.range.low), canonicalBytes(m.range.high))
+        else:
+            value = (m.SerializeToString(),)
+        fields.append((m.field_id, match_type) + value)
+    return (table_entry.table_id, tuple(fields), table_entry.priority)
+
+
+def actionKey(table_entry):
+    "Identifies what a table entry does, to detect entries needing a MODIFY"
+    action = table_entry.action
+    if action.WhichOneof("type") == 'action':
+        params = sorted((p.param_id, canonicalBytes(p.value))
+                        for p in action.action.params)
+        return (action.action.action_id, tuple(params))
+    return (action.WhichOneof("type"), action.SerializeToString())
+
+
+def readInstalledEntries(sw, table_ids=None):
+    """Reads the entries installed on the switch, from the given tables or
+    from all of them, into a dict indexed by matchKey()"""
+    installed = {}
+    for table_id in (table_ids or [None]):
+        for response in sw.ReadTableEntries(table_id=table_id):
+            for entity in response.entities:
+                entry = entity.table_entry
+                if not entry.is_default_action:
+                    installed[matchKey(entry)] = entry
+    return installed
+
+
+def diffEntries(installed, desired_entries):
+    """Compares the desired table entries with the installed ones.
+
+    installed is a dict indexed by matchKey(), as returned by
+    readInstalledEntries(); it is left untouched. Returns the lists of
+    entries to insert, modify and delete. Default entries are always
+    modified since they are not returned when reading a table.
+    """
+    remaining = dict(installed)
+    inserts = []
+    modifies = []
+    for entry in desired_entries:
+        if entry.is_default_action:
+            modifies.append(entry)
+            continue
+        current = remaining.pop(matchKey(entry), None)
+        if current is None:
+            inserts.append(entry)
+        elif actionKey(current) != actionKey(entry):
+            modifies.append(entry)
+    return inserts, modifies, remaining.values()
+
+
+def reconcile(sw, desired_entries, table_ids=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Makes the entries installed on the switch equal to desired_entries.
+
+    Only the tables in table_ids are considered if given, otherwise entries
+    of any table that are not desired are deleted, see applyDiff().
+    """
+    installed = readInstalledEntries(sw, table_ids)
+    inserts, modifies, deletes = diffEntries(installed, desired_entries)
+    return applyDiff(sw, inserts, modifies, deletes, batch_size)
+
+
+def applyDiff(sw, inserts, modifies, deletes, batch_size=DEFAULT_BATCH_SIZE):
+    """Writes a difference computed by diffEntries(). Deletes are written
+    and completed first to free table capacity for the inserts."""
+    sw.DeleteTableEntries(deletes, batch_size=batch_size, pipelined=True)
+    sw.flush()
+    sw.ModifyTableEntries(modifies, batch_size=batch_size, pipelined=True)
+    sw.WriteTableEntries(inserts, batch_size=batch_size, pipelined=True)
+    sw.flush()
+    return ReconcileResult(len(inserts), len(modifies), len(deletes))
@@ -18,9 +18,20 @@ import argparse
 import json
 import os
 import sys
+from collections import deque
+from functools import partial
+
+import grpc
+from p4.v1 import p4runtime_pb2
 
 import bmv2
+import bulk_writer
+import bundle
 import helper
+import parallel
+import reconcile
+import topology
+from switch import defaultUpdateType
 
 
 def error(msg):
@@ -39,19 +50,62 @@ def main():
 
     parser.add_argument('-a', '--p4runtime-server-addr',
                         help='address and port of the switch\'s P4Runtime server (e.g. 192.168.0.1:50051)',
-                        type=str, action="store", required=True)
+                        type=str, action="store", required=False)
     parser.add_argument('-d', '--device-id',
                         help='Internal device ID to use in P4Runtime messages',
-                        type=int, action="store", required=True)
+                        type=int, action="store", required=False)
     parser.add_argument('-p', '--proto-dump-file',
                         help='path to file where to dump protobuf messages sent to the switch',
-                        type=str, action="store", required=True)
+                        type=str, action="store", required=False)
     parser.add_argument("-c", '--runtime-conf-file',
-                        help="path to input runtime configuration file (JSON)",
-                        type=str, action="store", required=True)
+                        help="path to input runtime configuration file (JSON, JSON lines with a .jsonl extension, or a bundle compiled by bundle.py)",
+                        type=str, action="store", required=False)
+    parser.add_argument('-t', '--topo',
+                        help='topology file (JSON) whose switches are programmed from their runtime_json, instead of -a/-d/-p/-c',
+                        type=str, action="store", required=False)
+    parser.add_argument('--relative-paths',
+                        help='with --topo, resolve the runtime_json paths from the directory of the topology file and the paths in each runtime file from its directory, as with -c, instead of all from the working directory',
+                        action="store_true", default=False)
+    parser.add_argument('--watch',
+                        help='with --topo, keep running and apply the edits of the runtime JSON files',
+                        action="store_true", default=False)
+    parser.add_argument('-w', '--workers',
+                        help='with --topo, number of switches programmed concurrently',
+                        type=int, action="store", default=parallel.DEFAULT_MAX_WORKERS)
+    parser.add_argument('--atomicity',
+                        help='atomicity of the table entry writes: keep writing the rest of a batch after an error, or roll the batch back',
+                        choices=sorted(bulk_writer.ATOMICITY_CHOICES), default='continue')
+    parser.add_argument('-l', '--log-dir',
+                        help='with --topo, directory where to dump the protobuf messages sent to each switch',
+                        type=str, action="store", required=False)
+    parser.add_argument('--poll-interval',
+                        help='seconds between two checks of the runtime JSON files when inotify is not available',
+                        type=float, action="store", default=0.5)
 
     args = parser.parse_args()
 
+    if args.topo:
+        if not os.path.exists(args.topo):
+            parser.error("File %s does not exist!" % args.topo)
+        # paths are relative to the working directory, as in run_exercise.py,
+        # unless --relative-paths is given
+        switches = topology.runtime_switches(topology.load_topology(args.topo)['switches'])
+        workdir = os.getcwd()
+        if args.relative_paths:
+            workdir = os.path.dirname(os.path.abspath(args.topo))
+        if args.watch:
+            import watcher
+            watcher.watch_topology(switches, workdir=workdir, interval=args.poll_interval,
+                                   relative_paths=args.relative_paths)
+        elif not program_topology(switches, workdir, args.workers, args.log_dir,
+                                  bulk_writer.ATOMICITY_CHOICES[args.atomicity],
+                                  args.relative_paths):
+            sys.exit(1)
+        return
+
+    for arg_name in ('p4runtime_server_addr', 'device_id', 'proto_dump_file', 'runtime_conf_file'):
+        if getattr(args, arg_name) is None:
+            parser.error("--%s is required without --topo" % arg_name.replace('_', '-'))
     if not os.path.exists(args.runtime_conf_file):
         parser.error("File %s does not exist!" % args.runtime_conf_file)
     workdir = os.path.dirname(os.path.abspath(args.runtime_conf_file))
@@ -60,7 +114,43 @@ def main():
                        device_id=args.device_id,
                        sw_conf_file=sw_conf_file,
                        workdir=workdir,
-                       proto_dump_fpath=args.proto_dump_file)
+                       proto_dump_fpath=args.proto_dump_file,
+                       atomicity=bulk_writer.ATOMICITY_CHOICES[args.atomicity])
+
+
+def program_topology(switches, workdir, max_workers=parallel.DEFAULT_MAX_WORKERS,
+                     log_dir=None, atomicity=bulk_writer.CONTINUE_ON_ERROR,
+                     relative_paths=False):
+    """Programs the switches of a topology concurrently, see
+    topology.runtime_switches. Their runtime_json paths are relative to
+    workdir, and so are the paths in the runtime files unless relative_paths
+    is set, in which case they are relative to the directory of each file.
+    Prints the time taken by each switch and returns False if any of them
+    failed."""
+    def program(sw_name, addr, device_id, runtime_json):
+        proto_dump_fpath = None
+        if log_dir is not None:
+            proto_dump_fpath = os.path.join(log_dir, '%s-p4runtime-requests.txt' % sw_name)
+        runtime_json_fpath = os.path.join(workdir, runtime_json)
+        conf_workdir = workdir
+        if relative_paths:
+            conf_workdir = os.path.dirname(os.path.abspath(runtime_json_fpath))
+        with open(runtime_json_fpath, 'r') as sw_conf_file:
+            if not program_switch(addr=addr, device_id=device_id, sw_conf_file=sw_conf_file,
+                                  workdir=conf_workdir, proto_dump_fpath=proto_dump_fpath,
+                                  atomicity=atomicity):
+                raise ConfException("invalid runtime configuration %s" % runtime_json)
+
+    tasks = [(sw_name, partial(program, sw_name, *switches[sw_name]))
+             for sw_name in sorted(switches, key=topology.natural_key)]
+    try:
+        timings = parallel.run_tasks(tasks, max_workers=max_workers)
+    except parallel.ParallelTaskError as e:
+        error(str(e))
+        timings = e.timings
+    if timings:
+        print parallel.format_timings(timings)
+    return len(timings) == len(tasks)
 
 
 def check_switch_conf(sw_conf, workdir):
@@ -88,13 +178,25 @@ def check_switch_conf(sw_conf, workdir):
             raise ConfException("file does not exist %s" % real_path)
 
 
-def program_switch(addr, device_id, sw_conf_file, workdir, proto_dump_fpath):
-    sw_conf = json_load_byteified(sw_conf_file)
+def program_switch(addr, device_id, sw_conf_file, workdir, proto_dump_fpath,
+                   atomicity=bulk_writer.CONTINUE_ON_ERROR):
+    # (number of updates, bytes) of the precompiled WriteRequests of a bundle
+    bundle_records = None
+    # table entries of JSON files are read while they are written
+    conf_stream = None
     try:
+        if bundle.isBundle(sw_conf_file):
+            sw_conf, bundle_records = bundle.readBundle(sw_conf_file)
+            sw_conf = _byteify(sw_conf)
+            bundle.checkP4Info(sw_conf, workdir)
+        else:
+            jsonl = getattr(sw_conf_file, 'name', '').endswith('.jsonl')
+            conf_stream = RuntimeConfStream(sw_conf_file, jsonl=jsonl)
+            sw_conf = conf_stream.readHeader()
         check_switch_conf(sw_conf=sw_conf, workdir=workdir)
-    except ConfException as e:
+    except (ConfException, bundle.BundleException, ValueError) as e:
         error("While parsing input runtime configuration: %s" % str(e))
-        return
+        return False
 
     info('Using P4Info file %s...' % sw_conf['p4info'])
     p4info_fpath = os.path.join(workdir, sw_conf['p4info'])
@@ -116,37 +218,79 @@ def program_switch(addr, device_id, sw_conf_file, workdir, proto_dump_fpath):
         if target == "bmv2":
             info("Setting pipeline config (%s)..." % sw_conf['bmv2_json'])
             bmv2_json_fpath = os.path.join(workdir, sw_conf['bmv2_json'])
-            sw.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                           bmv2_json_file_path=bmv2_json_fpath)
+            pipeline_pushed = sw.SetForwardingPipelineConfig(
+                p4info=p4info_helper.p4info, bmv2_json_file_path=bmv2_json_fpath)
         else:
             raise Exception("Should not be here")
 
-        if 'table_entries' in sw_conf:
-            table_entries = sw_conf['table_entries']
-            info("Inserting %d table entries..." % len(table_entries))
-            for entry in table_entries:
-                info(tableEntryToString(entry))
-                insertTableEntry(sw, entry, p4info_helper)
+        if bundle_records is not None and pipeline_pushed:
+            info("Replaying %d table entries from bundle..." % sw_conf['updates'])
+            sw.WriteRawRequests(bundle_records, pipelined=True)
+            sw.flush()
+        elif bundle_records is not None:
+            info("Pipeline already installed, reconciling %d table entries from bundle..."
+                 % sw_conf['updates'])
+            result = reconcile.reconcile(
+                sw, list(bundle.bundleTableEntries(bundle_records)))
+            info("%d inserted, %d modified, %d deleted" % result)
+        elif pipeline_pushed:
+            info("Inserting table entries...")
+            count = insertTableEntries(sw, conf_stream.tableEntries(), p4info_helper,
+                                       atomicity)
+            info("%d table entries inserted" % count)
+        else:
+            # The tables kept their content, only write what changed
+            info("Pipeline already installed, reconciling table entries...")
+            result = reconcile.reconcile(
+                sw, (buildTableEntry(flow, p4info_helper)
+                     for flow in conf_stream.tableEntries()))
+            info("%d inserted, %d modified, %d deleted" % result)
 
         if 'multicast_group_entries' in sw_conf:
             group_entries = sw_conf['multicast_group_entries']
             info("Inserting %d group entries..." % len(group_entries))
             for entry in group_entries:
                 info(groupEntryToString(entry))
-                insertMulticastGroupEntry(sw, entry, p4info_helper)
+                insertMulticastGroupEntry(sw, entry, p4info_helper,
+                                          replace=not pipeline_pushed)
 
         if 'clone_session_entries' in sw_conf:
             clone_entries = sw_conf['clone_session_entries']
             info("Inserting %d clone entries..." % len(clone_entries))
             for entry in clone_entries:
                 info(cloneEntryToString(entry))
-                insertCloneGroupEntry(sw, entry, p4info_helper)
+                insertCloneGroupEntry(sw, entry, p4info_helper,
+                                      replace=not pipeline_pushed)
 
     finally:
         sw.shutdown()
+    return True
 
 
 def insertTableEntry(sw, flow, p4info_helper):
+    sw.WriteTableEntry(buildTableEntry(flow, p4info_helper))
+
+
+def insertTableEntries(sw, flows, p4info_helper, atomicity=bulk_writer.CONTINUE_ON_ERROR):
+    """Writes the entries of flows, which may be a stream, and returns their
+    number. Transient failures are retried, and a BulkWriteError is raised
+    for the entries that could not be written."""
+    def build_updates():
+        for flow in flows:
+            info(tableEntryToString(flow))
+            table_entry = buildTableEntry(flow, p4info_helper)
+            yield defaultUpdateType(table_entry), table_entry
+
+    writer = bulk_writer.BulkWriter(sw, atomicity=atomicity)
+    try:
+        writer.write(build_updates())
+    finally:
+        if writer.retried:
+            info("%d updates retried" % writer.retried)
+    return writer.written
+
+
+def buildTableEntry(flow, p4info_helper):
     table_name = flow['table']
     match_fields = flow.get('match') # None if not found
     action_name = flow['action_name']
@@ -154,7 +298,7 @@ def insertTableEntry(sw, flow, p4info_helper):
     action_params = flow['action_params']
     priority = flow.get('priority')  # None if not found
 
-    table_entry = p4info_helper.buildTableEntry(
+    return p4info_helper.buildTableEntry(
         table_name=table_name,
         match_fields=match_fields,
         default_action=default_action,
@@ -162,8 +306,6 @@ def insertTableEntry(sw, flow, p4info_helper):
         action_params=action_params,
         priority=priority)
 
-    sw.WriteTableEntry(table_entry)
-
 
 # object hook for josn library, use str instead of unicode object
 # https://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-from-json
@@ -190,6 +332,134 @@ def _byteify(data, ignore_dicts=False):
     return data
 
 
+# Size of the reads of RuntimeConfStream
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+class RuntimeConfStream(object):
+    """Reads a runtime configuration file incrementally, so the table entries
+    can be written while the rest of the file is still being parsed and
+    without holding all of them in memory.
+
+    The file is either a JSON object, or JSON lines (jsonl=True) made of a
+    first line with the configuration without its table entries, followed
+    by one table entry per line. conf holds the keys other than
+    table_entries read so far; it is complete once tableEntries() has been
+    exhausted.
+    """
+    def __init__(self, f, jsonl=False, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(object_hook=_byteify)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.conf = {}
+        # entries read before the end of the header, see readHeader()
+        self.pending = deque()
+        self.items = self.jsonlItems() if jsonl else self.jsonItems()
+
+    def readHeader(self, required_keys=('target', 'p4info', 'bmv2_json')):
+        """Reads until all the required keys are known and returns conf.
+        Table entries found before them are kept for tableEntries()."""
+        while not all(key in self.conf for key in required_keys):
+            item = next(self.items, None)
+            if item is None:
+                break
+            self.addItem(item)
+        return self.conf
+
+    def tableEntries(self):
+        "Yields the table entries, reading the rest of the file into conf"
+        while self.pending:
+            yield self.pending.popleft()
+        for key, value in self.items:
+            if key == 'table_entries':
+                yield value
+            else:
+                self.conf[key] = value
+
+    def addItem(self, item):
+        key, value = item
+        if key == 'table_entries':
+            self.pending.append(value)
+        else:
+            self.conf[key] = value
+
+    def jsonlItems(self):
+        header = None
+        for line in self.f:
+            if not line.strip():
+                continue
+            value = _byteify(self.decoder.decode(line), ignore_dicts=True)
+            if header is None:
+                header = value
+                for key, header_value in header.iteritems():
+                    yield key, header_value
+            else:
+                yield 'table_entries', value
+
+    def jsonItems(self):
+        "Yields (key, value) for each key of the object, and each table entry"
+        self.expect('{')
+        while not self.peek('}'):
+            key = self.decode()
+            self.expect(':')
+            if key != 'table_entries':
+                yield key, self.decode()
+            else:
+                self.expect('[')
+                while not self.peek(']'):
+                    yield key, self.decode()
+                    self.peek(',')
+            self.peek(',')
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skipSpaces(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def peek(self, char):
+        "Skips char if it is the next non-space character and returns whether it was"
+        self.skipSpaces()
+        if self.buf[self.pos:self.pos + 1] == char:
+            self.pos += 1
+            return True
+        if self.pos >= len(self.buf):
+            raise ConfException("unexpected end of file, expected %r" % char)
+        return False
+
+    def expect(self, char):
+        if not self.peek(char):
+            raise ConfException("expected %r at %r" % (char, self.buf[self.pos:self.pos + 20]))
+
+    def decode(self):
+        self.skipSpaces()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # incomplete value, unless the file is over
+                if not self.fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return _byteify(value, ignore_dicts=True)
+
+
 def tableEntryToString(flow):
     if 'match' in flow:
         match_str = ['%s=%s' % (match_name, str(flow['match'][match_name])) for match_name in
@@ -222,14 +492,25 @@ def cloneEntryToString(rule):
     ports_str = ', '.join(replicas)
     return 'Clone Session {0} => ({1}) ({2})'.format(clone_id, ports_str, packet_length_bytes)
 
-def insertMulticastGroupEntry(sw, rule, p4info_helper):
+def insertMulticastGroupEntry(sw, rule, p4info_helper, replace=False):
     mc_entry = p4info_helper.buildMulticastGroupEntry(rule["multicast_group_id"], rule['replicas'])
-    sw.WritePREEntry(mc_entry)
+    writePREEntry(sw, mc_entry, replace)
 
-def insertCloneGroupEntry(sw, rule, p4info_helper):
+def insertCloneGroupEntry(sw, rule, p4info_helper, replace=False):
     clone_entry = p4info_helper.buildCloneSessionEntry(rule['clone_session_id'], rule['replicas'],
                                                        rule.get('packet_length_bytes', 0))
-    sw.WritePREEntry(clone_entry)
+    writePREEntry(sw, clone_entry, replace)
+
+def writePREEntry(sw, pre_entry, replace):
+    # PRE entries survive when the pipeline push is skipped, so they may
+    # already exist from a previous run
+    if replace:
+        try:
+            sw.WritePREEntry(pre_entry, update_type=p4runtime_pb2.Update.MODIFY)
+            return
+        except grpc.RpcError:
+            pass
+    sw.WritePREEntry(pre_entry)
 
 
 if __name__ == '__main__':
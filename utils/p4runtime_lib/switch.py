@@ -12,17 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from Queue import Queue
+from Queue import Queue, Empty, Full
+from collections import deque
 from abc import abstractmethod
 from datetime import datetime
+import hashlib
+import threading
+import time
+import traceback
 
 import grpc
 from p4.v1 import p4runtime_pb2
 from p4.v1 import p4runtime_pb2_grpc
 from p4.tmp import p4config_pb2
 
+from error_utils import parseGrpcErrorBinaryDetails
+
 MSG_LOG_MAX_LEN = 1024
 
+# Maximum number of updates packed into a single WriteRequest
+DEFAULT_BATCH_SIZE = 256
+
+# Maximum number of outstanding Write RPCs per connection in pipelined mode
+DEFAULT_MAX_IN_FLIGHT = 16
+
+# Capacity of each per-type queue of received stream messages
+DEFAULT_STREAM_QUEUE_SIZE = 1024
+
 # List of all active connections
 connections = []
 
@@ -30,21 +46,54 @@ def ShutdownAllSwitchConnections():
     for c in connections:
         c.shutdown()
 
+class WriteError(Exception):
+    """First failure of a pipelined write, raised by SwitchConnection.flush().
+
+    index is the position of the failed update among all the updates written
+    in pipelined mode since the previous flush().
+    """
+    def __init__(self, index, grpc_error):
+        super(WriteError, self).__init__(
+            "Write failed at update %d: %s" % (index, grpc_error.details()))
+        self.index = index
+        self.grpc_error = grpc_error
+
 class SwitchConnection(object):
 
     def __init__(self, name=None, address='127.0.0.1:50051', device_id=0,
-                 proto_dump_file=None):
+                 proto_dump_file=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 stream_queue_size=DEFAULT_STREAM_QUEUE_SIZE):
         self.name = name
         self.address = address
         self.device_id = device_id
         self.p4info = None
+        self.max_in_flight = max_in_flight
+        # (future, index of its first update, completion callback or None)
+        # of the pending pipelined writes
+        self.in_flight = deque()
+        self.write_index = 0
+        self.write_error = None
         self.channel = grpc.insecure_channel(self.address)
         if proto_dump_file is not None:
             interceptor = GrpcRequestLogger(proto_dump_file)
             self.channel = grpc.intercept_channel(self.channel, interceptor)
         self.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        # Same RPC as client_stub.SetForwardingPipelineConfig, but taking an
+        # already serialized request, so cached pipeline configs are sent
+        # without being parsed and serialized again
+        self.set_pipeline_config_raw = self.channel.unary_unary(
+            '/p4.v1.P4Runtime/SetForwardingPipelineConfig',
+            request_serializer=None,
+            response_deserializer=p4runtime_pb2.SetForwardingPipelineConfigResponse.FromString)
+        # Write taking serialized requests, used to replay bundles
+        self.write_raw = self.channel.unary_unary(
+            '/p4.v1.P4Runtime/Write',
+            request_serializer=None,
+            response_deserializer=p4runtime_pb2.WriteResponse.FromString)
         self.requests_stream = IterableQueue()
         self.stream_msg_resp = self.client_stub.StreamChannel(iter(self.requests_stream))
+        self.stream_dispatcher = StreamDispatcher(self.stream_msg_resp, stream_queue_size)
+        self.stream_dispatcher.start()
         self.proto_dump_file = proto_dump_file
         connections.append(self)
 
@@ -66,39 +115,228 @@ class SwitchConnection(object):
             print "P4Runtime MasterArbitrationUpdate: ", request
         else:
             self.requests_stream.put(request)
-            for item in self.stream_msg_resp:
-                return item # just one
+            return self.stream_dispatcher.get('arbitration')
 
-    def SetForwardingPipelineConfig(self, p4info, dry_run=False, **kwargs):
-        device_config = self.buildDeviceConfig(**kwargs)
-        request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
-        request.election_id.low = 1
+    def SendPacketOut(self, packet_outs, dry_run=False):
+        """Sends a PacketOut, or an iterable of PacketOuts which are all
+        enqueued on the stream at once (see P4InfoHelper.buildPacketOut)"""
+        if isinstance(packet_outs, p4runtime_pb2.PacketOut):
+            packet_outs = [packet_outs]
+        requests = []
+        for packet_out in packet_outs:
+            request = p4runtime_pb2.StreamMessageRequest()
+            request.packet.CopyFrom(packet_out)
+            requests.append(request)
+        if dry_run:
+            for request in requests:
+                print "P4Runtime PacketOut:", request
+        else:
+            self.requests_stream.putMany(requests)
+
+    def PacketIns(self, p4info_helper, timeout=None):
+        """Yields the received packets as (payload, {metadata name: value})
+        tuples. Stops when no packet arrives for timeout seconds."""
+        while True:
+            try:
+                msg = self.GetStreamMessage('packet', timeout)
+            except Empty:
+                return
+            yield p4info_helper.decodePacketIn(msg.packet)
+
+    def AckDigestList(self, digest_list, dry_run=False):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.digest_ack.digest_id = digest_list.digest_id
+        request.digest_ack.list_id = digest_list.list_id
+        if dry_run:
+            print "P4Runtime DigestListAck:", request
+        else:
+            self.requests_stream.put(request)
+
+    def DigestLists(self, p4info_helper, timeout=None, ack=True):
+        """Yields the received digests as (digest name, [data tuple, ...])
+        batches, one per DigestList, acknowledging each list unless ack is
+        False. Stops when no list arrives for timeout seconds."""
+        while True:
+            try:
+                msg = self.GetStreamMessage('digest', timeout)
+            except Empty:
+                return
+            if ack:
+                self.AckDigestList(msg.digest)
+            yield p4info_helper.decodeDigestList(msg.digest)
+
+    def GetStreamMessage(self, msg_type, timeout=None):
+        """Returns the next received StreamMessageResponse of the given type
+        ('packet', 'digest', 'idle_timeout_notification', ...), raising
+        Queue.Empty if none arrives before the timeout"""
+        return self.stream_dispatcher.get(msg_type, timeout)
+
+    def SetStreamCallback(self, msg_type, callback):
+        """Calls callback(msg) from the stream reader thread for every message
+        of the given type instead of queuing it. callback=None restores
+        queuing. Callbacks must not block, or they stall all message types."""
+        self.stream_dispatcher.setCallback(msg_type, callback)
+
+    def StreamDrops(self):
+        "Returns the number of messages dropped because their queue was full, by type"
+        return self.stream_dispatcher.getDrops()
+
+    def buildPipelineConfig(self, p4info, **kwargs):
+        "Returns the cookie and the serialized ForwardingPipelineConfig"
+        device_config = self.buildDeviceConfig(**kwargs).SerializeToString()
+        digest = pipelineDigest(p4info.SerializeToString(), device_config)
+        return serializePipelineConfig(p4info, device_config, digest)
+
+    def GetPipelineCookie(self):
+        "Returns the cookie of the pipeline running on the switch, or None"
+        request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
         request.device_id = self.device_id
-        config = request.config
+        request.response_type = p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+        try:
+            response = self.client_stub.GetForwardingPipelineConfig(request)
+        except grpc.RpcError as e:
+            # Returned by the server when no pipeline has been set yet
+            if e.code() == grpc.StatusCode.FAILED_PRECONDITION:
+                return None
+            raise
+        if not response.config.HasField('cookie'):
+            return None
+        return response.config.cookie.cookie
 
-        config.p4info.CopyFrom(p4info)
-        config.p4_device_config = device_config.SerializeToString()
+    def SetForwardingPipelineConfig(self, p4info, dry_run=False, force=False, **kwargs):
+        """Pushes the pipeline to the switch, unless the switch already runs
+        a pipeline with the same cookie (i.e. the same p4info and device
+        config) and force is False. Pushing a pipeline clears all the tables.
 
+        Returns True if the pipeline was pushed, False if it was skipped.
+        """
+        cookie, config = self.buildPipelineConfig(p4info, **kwargs)
+        if not dry_run and not force and self.GetPipelineCookie() == cookie:
+            return False
+        request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+        request.election_id.low = 1
+        request.device_id = self.device_id
         request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
         if dry_run:
+            request.config.ParseFromString(config)
             print "P4Runtime SetForwardingPipelineConfig:", request
         else:
-            self.client_stub.SetForwardingPipelineConfig(request)
+            # Appending the serialized config field to the rest of the
+            # request is equivalent to setting request.config
+            self.set_pipeline_config_raw(
+                request.SerializeToString() +
+                encodeLengthDelimitedField(PIPELINE_CONFIG_FIELD, config))
+        return True
 
     def WriteTableEntry(self, table_entry, dry_run=False):
-        request = p4runtime_pb2.WriteRequest()
-        request.device_id = self.device_id
-        request.election_id.low = 1
-        update = request.updates.add()
-        if table_entry.is_default_action:
-            update.type = p4runtime_pb2.Update.MODIFY
-        else:
-            update.type = p4runtime_pb2.Update.INSERT
-        update.entity.table_entry.CopyFrom(table_entry)
+        self.WriteTableEntries([table_entry], dry_run=dry_run)
+
+    def WriteTableEntries(self, table_entries, batch_size=DEFAULT_BATCH_SIZE,
+                          dry_run=False, pipelined=False):
+        """Inserts table_entries, packing up to batch_size updates in each
+        WriteRequest. Default action entries are sent as MODIFY."""
+        self.WriteUpdates(((defaultUpdateType(table_entry), table_entry)
+                           for table_entry in table_entries),
+                          batch_size=batch_size, dry_run=dry_run,
+                          pipelined=pipelined)
+
+    def ModifyTableEntries(self, table_entries, batch_size=DEFAULT_BATCH_SIZE,
+                           dry_run=False, pipelined=False):
+        self.WriteUpdates(((p4runtime_pb2.Update.MODIFY, table_entry)
+                           for table_entry in table_entries),
+                          batch_size=batch_size, dry_run=dry_run,
+                          pipelined=pipelined)
+
+    def DeleteTableEntries(self, table_entries, batch_size=DEFAULT_BATCH_SIZE,
+                           dry_run=False, pipelined=False):
+        self.WriteUpdates(((p4runtime_pb2.Update.DELETE, table_entry)
+                           for table_entry in table_entries),
+                          batch_size=batch_size, dry_run=dry_run,
+                          pipelined=pipelined)
+
+    def WriteUpdates(self, updates, batch_size=DEFAULT_BATCH_SIZE, dry_run=False,
+                     pipelined=False):
+        """Sends (update_type, table_entry) pairs in batched WriteRequests.
+
+        A failed batch raises grpc.RpcError; the per-update errors can be
+        extracted with error_utils.parseGrpcErrorBinaryDetails. With
+        pipelined=True, up to max_in_flight requests are kept outstanding and
+        errors are only reported by flush(), which must be called once all
+        the updates have been submitted.
+        """
+        for request in self.buildWriteRequests(updates, batch_size):
+            if dry_run:
+                print "P4Runtime Write:", request
+            elif pipelined:
+                self._submitWrite(self.client_stub.Write.future, request,
+                                  len(request.updates))
+            else:
+                self.client_stub.Write(request)
+
+    def WriteRawRequests(self, requests, dry_run=False, pipelined=False):
+        """Sends already serialized WriteRequests, given as (number of
+        updates, bytes) tuples, e.g. the records of a bundle (see bundle.py).
+        Their device_id must be unset: the one of the connection is prepended
+        to each request. Errors are reported like in WriteUpdates."""
+        device_id = encodeVarintField(WRITE_DEVICE_ID_FIELD, self.device_id)
+        for n_updates, data in requests:
+            if dry_run:
+                print "P4Runtime Write:", p4runtime_pb2.WriteRequest.FromString(device_id + data)
+            elif pipelined:
+                self._submitWrite(self.write_raw.future, device_id + data, n_updates)
+            else:
+                self.write_raw(device_id + data)
+
+    def SubmitWrite(self, request, on_done, dry_run=False):
+        """Sends a WriteRequest pipelined like WriteUpdates(pipelined=True),
+        but reports its outcome by calling on_done(grpc_error), None meaning
+        success, once it completes, at the latest in flush(). Its failure is
+        not raised by flush()."""
         if dry_run:
             print "P4Runtime Write:", request
+            on_done(None)
         else:
-            self.client_stub.Write(request)
+            self._submitWrite(self.client_stub.Write.future, request,
+                              len(request.updates), on_done)
+
+    def flush(self):
+        """Waits for all the pipelined writes to complete and raises a
+        WriteError for the first one that failed."""
+        while self.in_flight:
+            self._reapWrite()
+        error = self.write_error
+        self.write_error = None
+        self.write_index = 0
+        if error is not None:
+            raise error
+
+    def _submitWrite(self, write_future, request, n_updates, on_done=None):
+        while len(self.in_flight) >= self.max_in_flight:
+            self._reapWrite()
+        future = write_future(request)
+        self.in_flight.append((future, self.write_index, on_done))
+        self.write_index += n_updates
+
+    def _reapWrite(self):
+        future, first_index, on_done = self.in_flight.popleft()
+        grpc_error = future.exception()
+        if on_done is not None:
+            on_done(grpc_error)
+            return
+        if grpc_error is None or self.write_error is not None:
+            return
+        index = first_index
+        p4_errors = parseGrpcErrorBinaryDetails(grpc_error)
+        if p4_errors:
+            index += p4_errors[0][0]
+        self.write_error = WriteError(index, grpc_error)
+
+    def buildWriteRequests(self, updates, batch_size=DEFAULT_BATCH_SIZE,
+                           atomicity=p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR):
+        return buildWriteRequests(updates, batch_size, self.device_id, atomicity)
+
+    def newWriteRequest(self, atomicity=p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR):
+        return newWriteRequest(self.device_id, atomicity)
 
     def ReadTableEntries(self, table_id=None, dry_run=False):
         request = p4runtime_pb2.ReadRequest()
@@ -133,18 +371,170 @@ class SwitchConnection(object):
                 yield response
 
 
-    def WritePREEntry(self, pre_entry, dry_run=False):
-        request = p4runtime_pb2.WriteRequest()
-        request.device_id = self.device_id
-        request.election_id.low = 1
+    def WritePREEntry(self, pre_entry, dry_run=False,
+                      update_type=p4runtime_pb2.Update.INSERT):
+        self.writeEntity('packet_replication_engine_entry', pre_entry,
+                         update_type, dry_run)
+
+    def WriteDigestEntry(self, digest_entry, dry_run=False,
+                         update_type=p4runtime_pb2.Update.INSERT):
+        "Subscribes to a digest, see P4InfoHelper.buildDigestEntry"
+        self.writeEntity('digest_entry', digest_entry, update_type, dry_run)
+
+    def writeEntity(self, entity_field, message, update_type, dry_run=False):
+        request = self.newWriteRequest()
         update = request.updates.add()
-        update.type = p4runtime_pb2.Update.INSERT
-        update.entity.packet_replication_engine_entry.CopyFrom(pre_entry)
+        update.type = update_type
+        getattr(update.entity, entity_field).CopyFrom(message)
         if dry_run:
             print "P4Runtime Write:", request
         else:
             self.client_stub.Write(request)
 
+PIPELINE_CONFIG_FIELD = p4runtime_pb2.SetForwardingPipelineConfigRequest.DESCRIPTOR.fields_by_name['config'].number
+
+def encodeVarint(value):
+    encoded = []
+    while value > 0x7f:
+        encoded.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    encoded.append(chr(value))
+    return ''.join(encoded)
+
+def decodeVarint(data, pos):
+    "Returns the varint starting at data[pos] and the position following it"
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def encodeVarintField(field_number, value):
+    "Encodes value as a protobuf integer field"
+    return encodeVarint(field_number << 3) + encodeVarint(value)
+
+def encodeLengthDelimitedField(field_number, data):
+    "Encodes data as a protobuf bytes or sub-message field"
+    return encodeVarint((field_number << 3) | 2) + encodeVarint(len(data)) + data
+
+def pipelineDigest(p4info_bytes, device_config_bytes):
+    "Content hash of a forwarding pipeline, used to derive its cookie"
+    return hashlib.sha256(hashlib.sha256(p4info_bytes).digest() +
+                          hashlib.sha256(device_config_bytes).digest()).hexdigest()
+
+def serializePipelineConfig(p4info, p4_device_config, digest):
+    config = p4runtime_pb2.ForwardingPipelineConfig()
+    config.p4info.CopyFrom(p4info)
+    config.p4_device_config = p4_device_config
+    config.cookie.cookie = int(digest[:16], 16)
+    return config.cookie.cookie, config.SerializeToString()
+
+WRITE_DEVICE_ID_FIELD = p4runtime_pb2.WriteRequest.DESCRIPTOR.fields_by_name['device_id'].number
+
+def newWriteRequest(device_id=0, atomicity=p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR):
+    request = p4runtime_pb2.WriteRequest()
+    request.device_id = device_id
+    request.election_id.low = 1
+    request.atomicity = atomicity
+    return request
+
+def buildWriteRequests(updates, batch_size=DEFAULT_BATCH_SIZE, device_id=0,
+                       atomicity=p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR):
+    "Packs (update_type, table_entry) pairs into WriteRequests of batch_size updates"
+    request = None
+    for update_type, table_entry in updates:
+        if request is None:
+            request = newWriteRequest(device_id, atomicity)
+        update = request.updates.add()
+        update.type = update_type
+        update.entity.table_entry.CopyFrom(table_entry)
+        if len(request.updates) >= batch_size:
+            yield request
+            request = None
+    if request is not None:
+        yield request
+
+def defaultUpdateType(table_entry):
+    # The default entry of a table always exists, so it can only be modified
+    if table_entry.is_default_action:
+        return p4runtime_pb2.Update.MODIFY
+    return p4runtime_pb2.Update.INSERT
+
+class StreamDispatcher(threading.Thread):
+    """Reads the StreamChannel of a connection in the background and sorts the
+    StreamMessageResponses by type (the name of their 'update' field) into
+    bounded queues, or hands them to the callback registered for their type.
+    Messages received while their queue is full are dropped and counted."""
+
+    def __init__(self, stream, queue_size=DEFAULT_STREAM_QUEUE_SIZE):
+        super(StreamDispatcher, self).__init__(name='StreamDispatcher')
+        self.daemon = True
+        self.stream = stream
+        self.queue_size = queue_size
+        self.queues = {}
+        self.callbacks = {}
+        self.drops = {}
+        self.lock = threading.Lock()
+        # Error that ended the stream, None if it was closed by shutdown()
+        self.error = None
+
+    def queue(self, msg_type):
+        with self.lock:
+            q = self.queues.get(msg_type)
+            if q is None:
+                q = self.queues[msg_type] = Queue(self.queue_size)
+            return q
+
+    def setCallback(self, msg_type, callback):
+        with self.lock:
+            if callback is None:
+                self.callbacks.pop(msg_type, None)
+            else:
+                self.callbacks[msg_type] = callback
+
+    def getDrops(self):
+        with self.lock:
+            return dict(self.drops)
+
+    def get(self, msg_type, timeout=None):
+        q = self.queue(msg_type)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.time())
+            try:
+                return q.get(timeout=max(wait, 0))
+            except Empty:
+                if not self.is_alive() and q.empty():
+                    if self.error is not None:
+                        raise self.error
+                    raise
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+    def run(self):
+        try:
+            for msg in self.stream:
+                msg_type = msg.WhichOneof('update')
+                callback = self.callbacks.get(msg_type)
+                if callback is not None:
+                    try:
+                        callback(msg)
+                    except Exception:
+                        traceback.print_exc()
+                    continue
+                try:
+                    self.queue(msg_type).put_nowait(msg)
+                except Full:
+                    with self.lock:
+                        self.drops[msg_type] = self.drops.get(msg_type, 0) + 1
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                self.error = e
+
 class GrpcRequestLogger(grpc.UnaryUnaryClientInterceptor,
                         grpc.UnaryStreamClientInterceptor):
     """Implementation of a gRPC interceptor that logs request to a file"""
@@ -180,5 +570,14 @@ class IterableQueue(Queue):
     def __iter__(self):
         return iter(self.get, self._sentinel)
 
+    def putMany(self, items):
+        "Enqueues several items taking the queue lock only once"
+        items = list(items)
+        with self.mutex:
+            for item in items:
+                self._put(item)
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify(len(items))
+
     def close(self):
         self.put(self._sentinel)
@@ -0,0 +1,146 @@
+#
+# Reads the entries of P4 tables into columnar NumPy arrays, one set of
+# columns per table. Responses are decoded as they are streamed, with the ids
+# resolved once per table and action, so whole tables can be audited and
+# compared without building a Python object per entry.
+#
+import numpy as np
+from p4.config.v1 import p4info_pb2
+
+from convert import decode_many
+
+
+class TableColumns(object):
+    """The entries of one table, as columns of equal length.
+
+    match maps each match field name to its values (the low end for range
+    matches); prefix_len, mask and high hold the extra column of the lpm,
+    ternary and range fields. action_id and priority have one value per
+    entry, and params maps action names to {param name: values}, where the
+    rows of entries using another action are 0. Values wider than 64 bits
+    are Python integers in object arrays, the others uint64.
+    """
+    def __init__(self, p4info_helper, table):
+        self.table_name = table.preamble.name
+        self.table_id = table.preamble.id
+        self.size = 0
+        self.fields = [(mf.id, mf.name, mf.match_type) for mf in table.match_fields]
+        self.match = {}
+        self.prefix_len = {}
+        self.mask = {}
+        self.high = {}
+        self.action_id = None
+        self.priority = None
+        self.params = {}
+
+        self.helper = p4info_helper
+        # raw values collected while streaming, decoded by finish()
+        self.raw_match = dict((name, []) for _, name, _ in self.fields)
+        self.raw_extra = dict((name, []) for _, name, _ in self.fields)
+        self.raw_action_ids = []
+        self.raw_priorities = []
+        # action id -> (action name, {param id: param name})
+        self.actions = {}
+        # (action name, param name) -> (rows, values)
+        self.raw_params = {}
+
+    def action(self, action_id):
+        action = self.actions.get(action_id)
+        if action is None:
+            action_name = self.helper.get_actions_name(action_id)
+            by_id = self.helper.action_params.get(action_name, ({}, {}))[1]
+            param_names = dict((param_id, p.name) for param_id, p in by_id.iteritems())
+            action = self.actions[action_id] = (action_name, param_names)
+        return action
+
+    def add(self, entry):
+        row = self.size
+        matches = dict((m.field_id, m) for m in entry.match)
+        for field_id, name, match_type in self.fields:
+            m = matches.get(field_id)
+            if m is None:
+                # wildcard of an optional match
+                value, extra = '', ''
+            elif match_type == p4info_pb2.MatchField.EXACT:
+                value, extra = m.exact.value, ''
+            elif match_type == p4info_pb2.MatchField.LPM:
+                value, extra = m.lpm.value, m.lpm.prefix_len
+            elif match_type == p4info_pb2.MatchField.TERNARY:
+                value, extra = m.ternary.value, m.ternary.mask
+            else:
+                value, extra = m.range.low, m.range.high
+            self.raw_match[name].append(value)
+            self.raw_extra[name].append(extra)
+
+        action = entry.action.action
+        self.raw_action_ids.append(action.action_id)
+        self.raw_priorities.append(entry.priority)
+        action_name, param_names = self.action(action.action_id)
+        for p in action.params:
+            key = (action_name, param_names.get(p.param_id, p.param_id))
+            self.raw_params.setdefault(key, ([], []))
+            rows, values = self.raw_params[key]
+            rows.append(row)
+            values.append(p.value)
+        self.size += 1
+
+    def finish(self):
+        "Decodes the collected values into the columns"
+        for _, name, match_type in self.fields:
+            self.match[name] = decode_many(self.raw_match[name])
+            extra = self.raw_extra[name]
+            if match_type == p4info_pb2.MatchField.LPM:
+                self.prefix_len[name] = np.array(extra, dtype=np.int32)
+            elif match_type == p4info_pb2.MatchField.TERNARY:
+                self.mask[name] = decode_many(extra)
+            elif match_type == p4info_pb2.MatchField.RANGE:
+                self.high[name] = decode_many(extra)
+        self.action_id = np.array(self.raw_action_ids, dtype=np.uint32)
+        self.priority = np.array(self.raw_priorities, dtype=np.int32)
+        for (action_name, param_name), (rows, values) in self.raw_params.iteritems():
+            decoded = decode_many(values)
+            column = np.zeros(self.size, dtype=decoded.dtype)
+            column[rows] = decoded
+            self.params.setdefault(action_name, {})[param_name] = column
+        del self.raw_match, self.raw_extra, self.raw_action_ids
+        del self.raw_priorities, self.raw_params
+        return self
+
+    def action_names(self):
+        "Returns the action name of every entry"
+        names = dict((action_id, name) for action_id, (name, _) in self.actions.iteritems())
+        return [names[action_id] for action_id in self.action_id]
+
+    def __len__(self):
+        return self.size
+
+
+def readTableColumns(sw, p4info_helper, table_names=None, action_names=None):
+    """Reads the entries of the switch into a {table name: TableColumns} dict.
+
+    Only the tables in table_names are read if given, otherwise all the
+    tables of the P4Info. Entries using an action that is not in
+    action_names are skipped if it is given.
+    """
+    if table_names is None:
+        tables = list(p4info_helper.p4info.tables)
+        read_ids = [None]
+    else:
+        tables = [p4info_helper.get('tables', name=name) for name in table_names]
+        read_ids = [table.preamble.id for table in tables]
+    columns = dict((table.preamble.id, TableColumns(p4info_helper, table)) for table in tables)
+    action_ids = None
+    if action_names is not None:
+        action_ids = set(p4info_helper.get_actions_id(name) for name in action_names)
+
+    for table_id in read_ids:
+        for response in sw.ReadTableEntries(table_id=table_id):
+            for entity in response.entities:
+                entry = entity.table_entry
+                if action_ids is not None and entry.action.action.action_id not in action_ids:
+                    continue
+                table_columns = columns.get(entry.table_id)
+                if table_columns is not None:
+                    table_columns.add(entry)
+
+    return dict((c.table_name, c.finish()) for c in columns.itervalues())
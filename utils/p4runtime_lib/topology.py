@@ -0,0 +1,51 @@
+#
+# Helpers to find the P4Runtime server of each switch of a topology.json,
+# for tools that connect to the switches of a network started by
+# run_exercise.py.
+#
+import json
+import re
+
+FIRST_GRPC_PORT = 50051
+FIRST_DEVICE_ID = 0
+
+
+def natural_key(name):
+    "Sorts s2 before s10, like mininet.util.natural"
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def load_topology(topo_file):
+    with open(topo_file, 'r') as f:
+        return json.load(f)
+
+
+def resolve_switch_endpoints(switches):
+    """Returns {switch name: (gRPC port, device id)} for the switches of a
+    topology. Switches may set 'grpc_port' and 'device_id' explicitly;
+    the others get consecutive ports and ids in the order Mininet creates
+    them, which is the natural order of their names."""
+    endpoints = {}
+    next_grpc_port = FIRST_GRPC_PORT
+    next_device_id = FIRST_DEVICE_ID
+    for sw_name in sorted(switches, key=natural_key):
+        params = switches[sw_name]
+        grpc_port = params.get('grpc_port', next_grpc_port)
+        device_id = params.get('device_id', next_device_id)
+        if 'grpc_port' not in params:
+            next_grpc_port += 1
+        next_device_id = max(next_device_id, device_id) + 1
+        endpoints[sw_name] = (grpc_port, device_id)
+    return endpoints
+
+
+def runtime_switches(switches, host='127.0.0.1'):
+    """Returns {switch name: (address, device id, runtime JSON path)} for the
+    switches of a topology programmed from a runtime JSON file"""
+    endpoints = resolve_switch_endpoints(switches)
+    result = {}
+    for sw_name, params in switches.iteritems():
+        if 'runtime_json' in params:
+            grpc_port, device_id = endpoints[sw_name]
+            result[sw_name] = ('%s:%d' % (host, grpc_port), device_id, params['runtime_json'])
+    return result
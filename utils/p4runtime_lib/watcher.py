@@ -0,0 +1,255 @@
+#
+# Watches the runtime JSON files of the switches of a topology and applies
+# their edits to the running switches as soon as they are saved. Each switch
+# keeps its connection open and the index of the entries last applied to it,
+# so an edit costs one file parse and the writes of the changed entries only.
+#
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+import grpc
+
+import bmv2
+import helper
+import reconcile
+import simple_controller
+from simple_controller import error, info
+from switch import WriteError
+
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Time to wait for the other events of a save (editors often write a file
+# in several steps) before reloading it
+SETTLE_DELAY = 0.05
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    "Reports the files written or replaced in a set of directories, with inotify"
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError("inotify is not supported")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.paths = set(paths)
+        # watch descriptor -> directory; directories are watched because
+        # editors often save by renaming a new file over the old one
+        self.dirs = {}
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            wd = self.libc.inotify_add_watch(self.fd, directory,
+                                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "cannot watch %s" % directory)
+            self.dirs[wd] = directory
+
+    def wait(self, timeout=None):
+        "Returns the watched paths modified before the timeout"
+        changed = set()
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return changed
+            data = os.read(self.fd, 4096)
+            pos = 0
+            while pos < len(data):
+                wd, _, _, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = data[pos:pos + name_len].rstrip('\0')
+                pos += name_len
+                path = os.path.join(self.dirs.get(wd, ''), name)
+                if path in self.paths:
+                    changed.add(path)
+            timeout = SETTLE_DELAY
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    "Reports the modified files of a set by checking their mtime and size"
+    def __init__(self, paths, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self.stats = dict((path, self.stat(path)) for path in paths)
+
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path, old_stat in self.stats.iteritems():
+                new_stat = self.stat(path)
+                if new_stat != old_stat:
+                    self.stats[path] = new_stat
+                    changed.add(path)
+            if changed:
+                time.sleep(SETTLE_DELAY)
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+            elif time.time() >= deadline:
+                return changed
+            else:
+                time.sleep(max(0, min(self.interval, deadline - time.time())))
+
+    def close(self):
+        pass
+
+
+def newFileWatcher(paths, interval=DEFAULT_POLL_INTERVAL):
+    "Watches paths with inotify if available, otherwise by polling them"
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            error("inotify not available (%s), polling files instead" % e)
+    return PollingWatcher(paths, interval)
+
+
+class WatchedSwitch(object):
+    """A switch programmed from a runtime JSON file, with the state last
+    applied to it: table entries by matchKey(), default entries by table id
+    and PRE entries as found in the file."""
+    def __init__(self, name, addr, device_id, conf_path, workdir, proto_dump_fpath=None):
+        self.name = name
+        self.addr = addr
+        self.device_id = device_id
+        self.conf_path = conf_path
+        self.workdir = workdir
+        self.proto_dump_fpath = proto_dump_fpath
+        self.sw = None
+        # None when unknown, e.g. after a failed write: the entries are then
+        # read back from the switch
+        self.applied = None
+        self.applied_defaults = {}
+        self.applied_pre = {}
+
+    def connect(self, target):
+        if target != "bmv2":
+            raise Exception("Don't know how to connect to target %s" % target)
+        info("Connecting to P4Runtime server on %s (%s)..." % (self.addr, target))
+        sw = bmv2.Bmv2SwitchConnection(name=self.name, address=self.addr,
+                                       device_id=self.device_id,
+                                       proto_dump_file=self.proto_dump_fpath)
+        try:
+            sw.MasterArbitrationUpdate()
+        except:
+            sw.shutdown()
+            raise
+        self.sw = sw
+
+    def load(self):
+        with open(self.conf_path, 'r') as sw_conf_file:
+            sw_conf = simple_controller.json_load_byteified(sw_conf_file)
+        simple_controller.check_switch_conf(sw_conf=sw_conf, workdir=self.workdir)
+        return sw_conf
+
+    def apply(self):
+        "Makes the switch match its runtime JSON file, writing only what changed"
+        start = time.time()
+        desired = {}
+        defaults = {}
+        try:
+            sw_conf = self.load()
+            p4info_helper = helper.P4InfoHelper(os.path.join(self.workdir, sw_conf['p4info']))
+            for flow in sw_conf.get('table_entries', []):
+                entry = simple_controller.buildTableEntry(flow, p4info_helper)
+                if entry.is_default_action:
+                    defaults[entry.table_id] = entry
+                else:
+                    desired[reconcile.matchKey(entry)] = entry
+        except Exception as e:
+            # typically a file saved in the middle of an edit; the switch
+            # keeps its state until the next save
+            error("%s: not applying %s: %s" % (self.name, self.conf_path, e))
+            return
+
+        try:
+            if self.sw is None:
+                self.connect(sw_conf['target'])
+            bmv2_json_fpath = os.path.join(self.workdir, sw_conf['bmv2_json'])
+            if self.sw.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
+                                                   bmv2_json_file_path=bmv2_json_fpath):
+                info("%s: pipeline changed, reinstalling all entries" % self.name)
+                self.applied = {}
+                self.applied_defaults = {}
+                self.applied_pre = {}
+            elif self.applied is None:
+                self.applied = reconcile.readInstalledEntries(self.sw)
+
+            inserts, modifies, deletes = reconcile.diffEntries(self.applied, desired.itervalues())
+            modifies += [entry for table_id, entry in defaults.iteritems()
+                         if self.applied_defaults.get(table_id) != entry]
+            reconcile.applyDiff(self.sw, inserts, modifies, deletes)
+            self.applyPREEntries(sw_conf, p4info_helper)
+        except (WriteError, grpc.RpcError) as e:
+            # the switch may have applied part of the writes
+            error("%s: %s" % (self.name, e))
+            self.applied = None
+            return
+        self.applied = desired
+        self.applied_defaults = defaults
+        info("%s: %d inserted, %d modified, %d deleted in %.3fs"
+             % (self.name, len(inserts), len(modifies), len(deletes), time.time() - start))
+
+    def applyPREEntries(self, sw_conf, p4info_helper):
+        for conf_key, write in (
+                ('multicast_group_entries', simple_controller.insertMulticastGroupEntry),
+                ('clone_session_entries', simple_controller.insertCloneGroupEntry)):
+            pre_entries = sw_conf.get(conf_key, [])
+            if pre_entries != self.applied_pre.get(conf_key, []):
+                for entry in pre_entries:
+                    write(self.sw, entry, p4info_helper, replace=True)
+                self.applied_pre[conf_key] = pre_entries
+
+    def shutdown(self):
+        if self.sw is not None:
+            self.sw.shutdown()
+
+
+def watch_topology(switches, workdir, interval=DEFAULT_POLL_INTERVAL, relative_paths=False):
+    """Applies the runtime JSON files of the given switches, then applies
+    every later edit of these files until interrupted.
+
+    switches maps switch names to (address, device id, runtime JSON path
+    relative to workdir), see topology.runtime_switches. The paths in the
+    runtime JSON files are relative to workdir too, or to the directory of
+    each file if relative_paths is set, see simple_controller.program_topology.
+    """
+    watched = {}
+    for sw_name, (addr, device_id, conf_path) in switches.iteritems():
+        conf_path = os.path.abspath(os.path.join(workdir, conf_path))
+        conf_workdir = os.path.dirname(conf_path) if relative_paths else workdir
+        watched[conf_path] = WatchedSwitch(sw_name, addr, device_id, conf_path, conf_workdir)
+
+    file_watcher = newFileWatcher(watched.keys(), interval)
+    try:
+        for watched_switch in watched.itervalues():
+            watched_switch.apply()
+        info("Watching %d runtime files, press Ctrl-C to stop" % len(watched))
+        while True:
+            for conf_path in file_watcher.wait(1.0):
+                watched[conf_path].apply()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        file_watcher.close()
+        for watched_switch in watched.itervalues():
+            watched_switch.shutdown()
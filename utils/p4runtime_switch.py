@@ -36,6 +36,7 @@ class P4RuntimeSwitch(P4Switch):
                  log_console = False,
                  verbose = False,
                  device_id = None,
+                 cpu_port = None,
                  enable_debugger = False,
                  log_file = None,
                  **kwargs):
@@ -87,6 +88,8 @@ class P4RuntimeSwitch(P4Switch):
             self.device_id = P4Switch.device_id
             P4Switch.device_id += 1
         self.nanomsg = "ipc:///tmp/bm-{}-log.ipc".format(self.device_id)
+        # port connecting the switch to the P4Runtime server for packet I/O
+        self.cpu_port = cpu_port
 
 
     def check_switch_started(self, pid):
@@ -121,6 +124,8 @@ class P4RuntimeSwitch(P4Switch):
             args.append('--thrift-port ' + str(self.thrift_port))
         if self.grpc_port:
             args.append("-- --grpc-server-addr 0.0.0.0:" + str(self.grpc_port))
+            if self.cpu_port is not None:
+                args.append("--cpu-port " + str(self.cpu_port))
         cmd = ' '.join(args)
         info(cmd + "\n")
 
@@ -20,6 +20,7 @@
 # environment used by the P4 tutorial.
 #
 import os, sys, json, subprocess, re, argparse
+from functools import partial
 from time import sleep
 
 from p4_mininet import P4Switch, P4Host
@@ -31,6 +32,9 @@ from mininet.cli import CLI
 
 from p4runtime_switch import P4RuntimeSwitch
 import p4runtime_lib.simple_controller
+from p4runtime_lib.parallel import (DEFAULT_MAX_WORKERS, ParallelTaskError,
+                                    format_timings, run_tasks)
+from p4runtime_lib.topology import resolve_switch_endpoints
 
 def configureP4Switch(**switch_args):
     """ Helper class that is called by mininet to initialize
@@ -79,7 +83,16 @@ class ExerciseTopo(Topo):
             else:
                 switch_links.append(link)
 
+        # Explicit P4Runtime endpoints, so that tools reading the topology
+        # file (e.g. simple_controller --watch) find the same ones
+        endpoints = {}
+        if 'grpc' in bmv2_exe:
+            endpoints = resolve_switch_endpoints(switches)
+
         for sw, params in switches.iteritems():
+            sw_opts = {}
+            if sw in endpoints:
+                sw_opts['grpc_port'], sw_opts['device_id'] = endpoints[sw]
             if "program" in params:
                 switchClass = configureP4Switch(
                         sw_path=bmv2_exe,
@@ -89,7 +102,7 @@ class ExerciseTopo(Topo):
             else:
                 # add default switch
                 switchClass = None
-            self.addSwitch(sw, log_file="%s/%s.log" %(log_dir, sw), cls=switchClass)
+            self.addSwitch(sw, log_file="%s/%s.log" %(log_dir, sw), cls=switchClass, **sw_opts)
 
         for link in host_links:
             host_name = link['node1']
@@ -150,7 +163,8 @@ class ExerciseRunner:
 
 
     def __init__(self, topo_file, log_dir, pcap_dir,
-                       switch_json, bmv2_exe='simple_switch', quiet=False):
+                       switch_json, bmv2_exe='simple_switch', quiet=False,
+                       program_workers=DEFAULT_MAX_WORKERS):
         """ Initializes some attributes and reads the topology json. Does not
             actually run the exercise. Use run_exercise() for that.
 
@@ -162,6 +176,7 @@ class ExerciseRunner:
                 switch_json : string  // Path to a compiled p4 json for bmv2
                 bmv2_exe    : string  // Path to the p4 behavioral binary
                 quiet : bool          // Enable/disable script debug messages
+                program_workers : int // Number of switches programmed concurrently
         """
 
         self.quiet = quiet
@@ -182,6 +197,7 @@ class ExerciseRunner:
         self.pcap_dir = pcap_dir
         self.switch_json = switch_json
         self.bmv2_exe = bmv2_exe
+        self.program_workers = program_workers
 
 
     def run_exercise(self):
@@ -196,7 +212,12 @@ class ExerciseRunner:
 
         # some programming that must happen after the net has started
         self.program_hosts()
-        self.program_switches()
+        try:
+            self.program_switches()
+        except ParallelTaskError as e:
+            print(str(e))
+            self.net.stop()
+            sys.exit(1)
 
         # wait for that to finish. Not sure how to do this better
         sleep(1)
@@ -268,12 +289,14 @@ class ExerciseRunner:
         self.logger('Configuring switch %s using P4Runtime with file %s' % (sw_name, runtime_json))
         with open(runtime_json, 'r') as sw_conf_file:
             outfile = '%s/%s-p4runtime-requests.txt' %(self.log_dir, sw_name)
-            p4runtime_lib.simple_controller.program_switch(
-                addr='127.0.0.1:%d' % grpc_port,
-                device_id=device_id,
-                sw_conf_file=sw_conf_file,
-                workdir=os.getcwd(),
-                proto_dump_fpath=outfile)
+            if not p4runtime_lib.simple_controller.program_switch(
+                    addr='127.0.0.1:%d' % grpc_port,
+                    device_id=device_id,
+                    sw_conf_file=sw_conf_file,
+                    workdir=os.getcwd(),
+                    proto_dump_fpath=outfile):
+                raise p4runtime_lib.simple_controller.ConfException(
+                    "invalid runtime configuration %s" % runtime_json)
 
     def program_switch_cli(self, sw_name, sw_dict):
         """ This method will start up the CLI and use the contents of the
@@ -297,11 +320,18 @@ class ExerciseRunner:
             P4Runtime, depending if any command or runtime JSON files were
             provided for the switches.
         """
+        p4runtime_tasks = []
         for sw_name, sw_dict in self.switches.iteritems():
             if 'cli_input' in sw_dict:
                 self.program_switch_cli(sw_name, sw_dict)
             if 'runtime_json' in sw_dict:
-                self.program_switch_p4runtime(sw_name, sw_dict)
+                p4runtime_tasks.append(
+                    (sw_name, partial(self.program_switch_p4runtime, sw_name, sw_dict)))
+        # P4Runtime switches are programmed concurrently, each one over its
+        # own connection
+        timings = run_tasks(p4runtime_tasks, max_workers=self.program_workers)
+        if timings:
+            self.logger('Switch programming times:\n' + format_timings(timings))
 
     def program_hosts(self):
         """ Execute any commands provided in the topology.json file on each Mininet host
@@ -369,6 +399,8 @@ def get_args():
     parser.add_argument('-j', '--switch_json', type=str, required=False)
     parser.add_argument('-b', '--behavioral-exe', help='Path to behavioral executable',
                                 type=str, required=False, default='simple_switch')
+    parser.add_argument('-w', '--program-workers', help='Number of switches programmed concurrently',
+                        type=int, required=False, default=DEFAULT_MAX_WORKERS)
     return parser.parse_args()
 
 
@@ -378,7 +410,8 @@ if __name__ == '__main__':
 
     args = get_args()
     exercise = ExerciseRunner(args.topo, args.log_dir, args.pcap_dir,
-                              args.switch_json, args.behavioral_exe, args.quiet)
+                              args.switch_json, args.behavioral_exe, args.quiet,
+                              args.program_workers)
 
     exercise.run_exercise()
 